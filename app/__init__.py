@@ -1,8 +1,9 @@
 from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
-from config import config
+from config import config, Config
 from flask_apscheduler import APScheduler
 import logging
+import os
 import redis
 import queue
 from flask_sqlalchemy import SQLAlchemy as SQLAlchemyBase
@@ -13,6 +14,8 @@ import threading
 from fdfs_client.client import *
 from flask_session import Session
 from werkzeug.middleware.proxy_fix import ProxyFix
+from .redis_layer import InstrumentedRedis
+from .log_pipeline import setup_logging, parse_module_levels
 
 # class SQLAlchemy(SQLAlchemyBase):
 #     def apply_driver_hacks(self, app, info, options):
@@ -22,27 +25,33 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 
 
 # 用于存放监控记录信息，例如UPS前序状态，需要配置持久化
-redis_db = redis.Redis(host='localhost', port=6379, db=7, decode_responses=True)
+# 连接池大小需覆盖web线程、派发worker及后台线程数，连接用尽时最多等待REDIS_POOL_TIMEOUT秒
+redis_pool = redis.BlockingConnectionPool(host='localhost', port=6379, db=7, decode_responses=True,
+                                          max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS') or 64),
+                                          timeout=int(os.environ.get('REDIS_POOL_TIMEOUT') or 5))
+redis_db = InstrumentedRedis(connection_pool=redis_pool)
 
 db = SQLAlchemy()
 scheduler = APScheduler()
 sess = Session()
 default_api = Api(title='AlgoSpace Dispatch API', version='v0.1', prefix='/api', contact='jinzhang.chen@algospace.com')
 
-# 用于处理订单建议书的队列
+# 用于处理订单建议书的队列，由dispatcher.DispatchPool消费，深度由DISPATCH_QUEUE_SIZE配置
 work_q = queue.Queue(maxsize=100)
 
 # 用于处理请求request的队列
 request_q = queue.Queue(maxsize=1000)
 
-logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
+# 日志在导入时配置，早于create_app，因此读取的是Config的类属性(环境变量)
 logger = logging.getLogger()
-hdlr = logging.FileHandler("run.log")
-formatter = logging.Formatter(fmt='%(asctime)s - %(module)s-%(funcName)s - %(levelname)s - %(message)s',
-                              datefmt='%m/%d/%Y %H:%M:%S')
-hdlr.setFormatter(formatter)
-logger.addHandler(hdlr)
-logger.setLevel(logging.DEBUG)
+log_handler = setup_logging(logger, Config.LOG_FILE,
+                            level=logging.getLevelName(Config.LOG_LEVEL.upper()),
+                            module_levels=parse_module_levels(Config.LOG_MODULE_LEVELS),
+                            sample_rate=Config.LOG_DEBUG_SAMPLE_RATE,
+                            queue_size=Config.LOG_QUEUE_SIZE,
+                            max_bytes=Config.LOG_MAX_BYTES,
+                            backup_count=Config.LOG_BACKUP_COUNT,
+                            drop_report_interval=Config.LOG_DROP_REPORT_INTERVAL)
 
 SECRET_KEY = '12kid9k29dj3nd8_2323'
 
@@ -77,13 +86,41 @@ def create_app(config_name):
     app.config.from_object(config[config_name])
     app.wsgi_app = ProxyFix(app.wsgi_app)
     config[config_name].init_app(app)
+    if app.config.get('METRICS_DB_POOL', True):
+        from .metrics import TimedQueuePool
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', dict()).setdefault('poolclass', TimedQueuePool)
+    from .metrics import LOG_RECORDS_DROPPED
+    if LOG_RECORDS_DROPPED.inc not in log_handler.listeners:
+        log_handler.listeners.append(LOG_RECORDS_DROPPED.inc)
     db.app = app
     db.init_app(app)
     default_api.init_app(app)
     db.create_scoped_session()
     scheduler.init_app(app)
     sess.init_app(app)
-    scheduler.start()
+    # 以暂停状态启动，由scheduler_leader决定当前worker是否执行定时任务
+    scheduler.start(paused=True)
+
+    from .scheduler_leader import scheduler_leader
+    scheduler_leader.init_app(app)
+
+    from .dispatcher import dispatch_pool
+    dispatch_pool.init_app(app)
+
+    from .job_watcher import start_job_watchers
+    start_job_watchers(app)
+
+    from .profiler import profiler
+    profiler.init_app(app)
+
+    from .role_registry import customer_roles
+    if customer_roles is not None:
+        with app.app_context():
+            try:
+                customer_roles.warm()
+            except Exception as e:
+                # 预热失败时在第一次查询时加载
+                logger.error(f"warm {customer_roles.table} registry failed, {e}")
 
     # @default_api.errorhandler(Exception)
     # def generic_exception_handler(e: Exception):
@@ -123,4 +160,7 @@ def create_app(config_name):
     from .algocap import algocap as algocap_blueprint
     app.register_blueprint(algocap_blueprint)
 
+    from .admin import admin as admin_blueprint
+    app.register_blueprint(admin_blueprint)
+
     return app
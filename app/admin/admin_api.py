@@ -0,0 +1,75 @@
+from flask import make_response
+from flask_restplus import Resource
+from . import admin
+from .. import default_api, redis_db, work_q, request_q
+from ..models import PermissionIP, TrustedProxies
+from ..decorators import permission_ip
+from ..swagger import return_dict
+from ..profiler import profiler
+from ..metrics import render_metrics, observe_queues
+from ..scheduler_leader import scheduler_leader
+from app.common import success_return
+import os
+
+admin_ns = default_api.namespace('admin', path='/admin',
+                                 description='运维接口，只允许permission_ip中的地址访问')
+
+return_json = admin_ns.model('ReturnRegister', return_dict)
+
+
+@admin_ns.route('/slow_queries')
+class SlowQueriesApi(Resource):
+    @admin_ns.marshal_with(return_json)
+    @permission_ip(PermissionIP, TrustedProxies)
+    def get(self):
+        """
+        当前worker进程中最慢的SQL及其调用栈，需开启PROFILER_ENABLED
+        """
+        return success_return(data={"pid": os.getpid(),
+                                    "enabled": profiler.enabled,
+                                    "threshold_ms": profiler.slow_statements.threshold * 1000,
+                                    "statements": profiler.slow_statements.snapshot()})
+
+    @admin_ns.marshal_with(return_json)
+    @permission_ip(PermissionIP, TrustedProxies)
+    def delete(self):
+        """
+        清空当前worker进程的慢SQL记录
+        """
+        profiler.slow_statements.clear()
+        return success_return(message=f"worker {os.getpid()} slow queries cleared")
+
+
+@admin_ns.route('/redis_stats')
+class RedisStatsApi(Resource):
+    @admin_ns.marshal_with(return_json)
+    @permission_ip(PermissionIP, TrustedProxies)
+    def get(self):
+        """
+        当前worker进程中各Redis命令的调用次数及耗时
+        """
+        return success_return(data={"pid": os.getpid(), "commands": redis_db.stats.snapshot()})
+
+
+@admin_ns.route('/scheduler')
+class SchedulerApi(Resource):
+    @admin_ns.marshal_with(return_json)
+    @permission_ip(PermissionIP, TrustedProxies)
+    def get(self):
+        """
+        定时任务的当前leader、各任务最近一次执行结果及执行记录
+        """
+        return success_return(data=scheduler_leader.status())
+
+
+@admin.route('/metrics')
+@permission_ip(PermissionIP, TrustedProxies)
+def metrics():
+    """
+    Prometheus文本格式的指标，不经过restplus的json封装
+    """
+    observe_queues(work_q=work_q, request_q=request_q)
+    body, content_type = render_metrics()
+    response = make_response(body)
+    response.headers['Content-Type'] = content_type
+    return response
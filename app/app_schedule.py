@@ -1,17 +1,109 @@
 from app.public_method import order_cancel, submit_return
-from app.models import ShopOrders
-from app import logger
+from app.common import session_commit
+from app.models import ShopOrders, make_uuid, ORDER_PAY_TIMEOUT, CHECK_ORDERS_CHUNK, CHECK_ORDERS_LOCK_EXPIRE
+from app import logger, redis_db, scheduler, db
+from sqlalchemy import and_, or_
 import datetime
+import json
+
+CHECK_ORDERS_LOCK = "check_orders::lock"
+# 上次处理到的(create_at, id)，只扫描其后新超时的订单
+CHECK_ORDERS_WATERMARK = "check_orders::watermark"
+# 取消失败的订单，下次运行时重试
+CHECK_ORDERS_RETRY = "check_orders::retry"
+
+
+def _load_watermark():
+    watermark = redis_db.get(CHECK_ORDERS_WATERMARK)
+    if not watermark:
+        return None
+    watermark = json.loads(watermark)
+    return datetime.datetime.strptime(watermark['create_at'], "%Y-%m-%d %H:%M:%S.%f"), watermark['id']
+
+
+def _save_watermark(create_at, order_id):
+    redis_db.set(CHECK_ORDERS_WATERMARK,
+                 json.dumps({"create_at": create_at.strftime("%Y-%m-%d %H:%M:%S.%f"), "id": order_id}))
+
+
+def _unpaid():
+    return db.session.query(ShopOrders).filter(ShopOrders.is_pay.__ne__(1),
+                                               ShopOrders.status.__eq__(1),
+                                               ShopOrders.delete_at.__eq__(None))
+
+
+def _cancel_chunk(order_ids):
+    """
+    按id顺序锁定本批订单，重新确认仍未支付后逐个取消，整批一次提交。
+    每个订单在各自的savepoint中取消，失败时只回滚该订单已flush的修改
+    :return: 取消失败的订单id
+    """
+    failed = list()
+    orders = _unpaid().with_for_update().filter(ShopOrders.id.in_(order_ids)).order_by(ShopOrders.id).all()
+    for order in orders:
+        try:
+            with db.session.begin_nested():
+                order_cancel("超时未支付", order.id)
+        except Exception as e:
+            logger.error(f"cancel pay timeout order {order.id} failed, {e}")
+            failed.append(order.id)
+    commit_result = session_commit()
+    # 提交失败时session_commit返回(false_return, 400)
+    if not isinstance(commit_result, dict) or commit_result.get('code') != 'success':
+        return list(order_ids)
+    logger.info(f"{len(orders) - len(failed)} orders have been cancelled for pay timeout")
+    return failed
+
+
+def _sweep():
+    cutoff = datetime.datetime.now() - ORDER_PAY_TIMEOUT
+
+    # 处理完成(取消成功或已不需要取消)的订单才从重试集合中移除，中途异常时集合保持不变
+    retry_ids = redis_db.smembers(CHECK_ORDERS_RETRY)
+    if retry_ids:
+        failed = {str(order_id) for order_id in _cancel_chunk(list(retry_ids))}
+        handled = [order_id for order_id in retry_ids if order_id not in failed]
+        if handled:
+            redis_db.srem(CHECK_ORDERS_RETRY, *handled)
+
+    # 按(create_at, id)分段取出已超时的订单，需要(status, delete_at, create_at, id)上的索引，
+    # is_pay != 1是范围条件，放在索引中会使create_at无法用于范围查找和排序，只作为回表后的过滤条件
+    watermark = _load_watermark()
+    while True:
+        query = db.session.query(ShopOrders.id, ShopOrders.create_at).filter(
+            ShopOrders.is_pay.__ne__(1),
+            ShopOrders.status.__eq__(1),
+            ShopOrders.delete_at.__eq__(None),
+            ShopOrders.create_at.__lt__(cutoff))
+        if watermark:
+            # MySQL对行构造器比较不一定能用上索引，展开为范围条件
+            query = query.filter(or_(ShopOrders.create_at.__gt__(watermark[0]),
+                                     and_(ShopOrders.create_at.__eq__(watermark[0]),
+                                          ShopOrders.id.__gt__(watermark[1]))))
+        chunk = query.order_by(ShopOrders.create_at, ShopOrders.id).limit(CHECK_ORDERS_CHUNK).all()
+        if not chunk:
+            break
+        failed = _cancel_chunk([order_id for order_id, _ in chunk])
+        if failed:
+            redis_db.sadd(CHECK_ORDERS_RETRY, *failed)
+        watermark = (chunk[-1].create_at, chunk[-1].id)
+        _save_watermark(*watermark)
+        if len(chunk) < CHECK_ORDERS_CHUNK:
+            break
 
 
 def check_orders():
-    shop_orders = ShopOrders.query.filter(ShopOrders.is_pay.__ne__(1),
-                                          ShopOrders.status.__eq__(1),
-                                          ShopOrders.delete_at.__eq__(None)).all()
-
-    for order in shop_orders:
-        logger.debug(order)
-        if datetime.datetime.now() - order.create_at > datetime.timedelta(hours=48):
-            logger.debug(f"pay timeout order {order.id}")
-            order_cancel("超时未支付", order.id)
-            logger.info(f"{order.id} has been cancelled for pay timeout!")
+    """
+    取消超过ORDER_PAY_TIMEOUT仍未支付的订单。每个进程都会启动APScheduler，
+    通过Redis锁保证同一时间只有一个进程在执行
+    """
+    token = make_uuid()
+    if not redis_db.set(CHECK_ORDERS_LOCK, token, nx=True, ex=CHECK_ORDERS_LOCK_EXPIRE):
+        logger.debug("check_orders is running in another worker, skip")
+        return
+    try:
+        with scheduler.app.app_context():
+            _sweep()
+    finally:
+        # 只释放自己持有的锁，超时后被其他进程获取的锁不受影响
+        redis_db.check_and_delete(CHECK_ORDERS_LOCK, token)
@@ -7,6 +7,7 @@ from ..common import success_return, false_return, session_commit, code_return,
 from ..public_method import new_data_obj
 from sqlalchemy import or_
 from ..public_method import table_fields, get_table_data_by_id
+from ..session_cache import backstage_sessions
 
 
 def encode_auth_token(user_id, login_time, login_ip, platform):
@@ -71,6 +72,7 @@ def authenticate(username, password, login_ip, platform, method='password'):
     # 查询并删除已经登陆的信息
     logged_in_info = user_info.login_info.filter_by(platform=platform, status=True).all()
     for lg in logged_in_info:
+        backstage_sessions.invalidate(lg.token)
         db.session.delete(lg)
     session_commit()
 
@@ -138,6 +140,12 @@ def identify(request):
             result = false_return(message='请传递正确的验证头信息')
         else:
             auth_token = auth_token_arr[1]
+            session = backstage_sessions.get(auth_token)
+            if session:
+                return success_return(data={"user_id": session['user_id'],
+                                            "login_info_id": session['login_info_id'],
+                                            "token": auth_token},
+                                      message='请求成功')
             if not LoginInfo.query.filter_by(token=auth_token).first():
                 return false_return(message='认证失败')
             payload = decode_auth_token(auth_token)
@@ -149,7 +157,11 @@ def identify(request):
                 else:
                     login_info = LoginInfo.query.filter_by(token=auth_token, user=user.id).first()
                     if login_info and login_info.login_time == data['login_time']:
-                        result = success_return(data={"user": user, "login_info": login_info}, message='请求成功')
+                        backstage_sessions.set(auth_token, payload['data']['exp'], user_id=user.id,
+                                       login_info_id=login_info.id)
+                        result = success_return(data={"user_id": user.id, "login_info_id": login_info.id,
+                                                      "token": auth_token},
+                                                message='请求成功')
                     else:
                         result = false_return(message='Token已更改，请重新登录获取')
             else:
@@ -0,0 +1,102 @@
+import yaml
+import re
+
+PLACEHOLDER_PATTERN = re.compile(r'^<(.*?)>$')
+
+
+class TemplateError(Exception):
+    pass
+
+
+def container_command(cfg):
+    try:
+        return cfg['spec']['template']['spec']['containers'][0]['command']
+    except (KeyError, IndexError, TypeError):
+        raise TemplateError('yaml does not contain spec.template.spec.containers[0].command')
+
+
+class CompiledCommand:
+    """
+    job yaml中container command的编译结果，只需解析一次。
+    字面参数保持原顺序；占位参数<_,job_name,tag>渲染后追加在字面参数之后，与原run_job一致。
+    job_name为空或为当前job时取自身tag，为父级job时取父级tag及其output
+    """
+
+    def __init__(self, literals, placeholders):
+        self.literals = literals
+        # [(原始参数, tag所属job, tag), ...]
+        self.placeholders = placeholders
+
+    def render(self, job_name, parent_name, tags, params):
+        """
+        :param tags: 当前job的tag
+        :param params: 父级job的tag及output合并的dict
+        :return: 新的command list
+        :raise TemplateError: 有无法替换的占位参数
+        """
+        values = list()
+        unresolved = list()
+        for raw, belong, tag in self.placeholders:
+            if not belong or belong == job_name:
+                source = tags
+            elif parent_name and belong == parent_name:
+                source = params
+            else:
+                source = dict()
+            if tag in source:
+                values.append(source[tag])
+            else:
+                unresolved.append(raw)
+        if unresolved:
+            raise TemplateError(f"job {job_name} has unresolved command placeholders {unresolved}")
+        return self.literals + values
+
+    def validate(self, job_name, parent_name=None, tags=None):
+        """
+        上传配置时校验占位参数，tags为None时不校验自身tag是否存在
+        :raise TemplateError:
+        """
+        errors = list()
+        for raw, belong, tag in self.placeholders:
+            if not belong or belong == job_name:
+                if tags is not None and tag not in tags:
+                    errors.append(f"{raw}: job {job_name} has no tag {tag}")
+            elif belong != parent_name:
+                errors.append(f"{raw}: {belong} is neither job {job_name} nor its parent")
+        if errors:
+            raise TemplateError('; '.join(errors))
+
+
+def compile_command(command):
+    """
+    :param command: yaml中的command list
+    :return: CompiledCommand
+    :raise TemplateError: 占位参数格式不是<_,job_name,tag>
+    """
+    literals = list()
+    placeholders = list()
+    for arg in command:
+        matched = PLACEHOLDER_PATTERN.match(str(arg))
+        if not matched:
+            literals.append(arg)
+            continue
+        parts = matched.group(1).split(',')
+        if len(parts) != 3 or not parts[2]:
+            raise TemplateError(f"placeholder {arg} should be <_,job_name,tag>")
+        placeholders.append((arg, parts[1], parts[2]))
+    return CompiledCommand(literals, placeholders)
+
+
+def validate_upload(file, job_name, parent_name=None, tags=None):
+    """
+    校验上传的job yaml，读取后将文件指针复位，不影响后续上传
+    :param file: werkzeug FileStorage
+    :raise TemplateError:
+    """
+    try:
+        cfg = yaml.safe_load(file.stream)
+    except yaml.YAMLError as e:
+        raise TemplateError(f"invalid yaml, {e}")
+    finally:
+        file.stream.seek(0)
+    compile_command(container_command(cfg)).validate(job_name, parent_name, tags)
@@ -0,0 +1,89 @@
+from sqlalchemy import literal
+from sqlalchemy.orm import aliased
+from collections import defaultdict, Counter
+from . import db
+from .models import Jobs, Orders, make_uuid, ORDER_PENDING
+
+# 递归查询的最大深度，防止parent_id数据错误形成环
+MAX_DAG_DEPTH = 50
+
+# run_downstream可以启动的运行环境
+RUNNABLE_ENVS = ('k8sm01', 'k8sm02')
+
+
+def load_subtree(root_id):
+    """
+    使用一次递归CTE查询取出root及其所有下游job
+    :param root_id: Jobs.id
+    :return: [(job, depth), ...]，root的depth为0
+    """
+    child = aliased(Jobs)
+    subtree = db.session.query(Jobs.id.label('id'), literal(0).label('depth')) \
+        .filter(Jobs.id.__eq__(root_id)).cte(name='job_subtree', recursive=True)
+    subtree = subtree.union_all(
+        db.session.query(child.id, subtree.c.depth + 1)
+            .filter(child.parent_id.__eq__(subtree.c.id), subtree.c.depth.__lt__(MAX_DAG_DEPTH)))
+    return db.session.query(Jobs, subtree.c.depth).join(subtree, Jobs.id.__eq__(subtree.c.id)).all()
+
+
+def _levels(rows):
+    levels = defaultdict(list)
+    for job, depth in rows:
+        levels[depth].append(job)
+    # 同一层中按seq排序，seq相同时按名称保证结果稳定
+    return [sorted(levels[depth], key=lambda j: (j.seq or 0, j.name)) for depth in sorted(levels.keys())]
+
+
+def build_plan(root):
+    """
+    生成root及其下游job的执行计划，按拓扑层级划分，同层按seq排序
+    :param root: Jobs对象
+    :return: dict
+    """
+    levels = _levels(load_subtree(root.id))
+    names = {job.id: job.name for level in levels for job in level}
+    plan_levels = list()
+    for depth, level in enumerate(levels):
+        plan_levels.append({"level": depth,
+                            "jobs": [{"id": job.id,
+                                      "name": job.name,
+                                      "parent": names.get(job.parent_id) if depth else None,
+                                      "seq": job.seq or 0,
+                                      "run_env": job.run_env,
+                                      "runnable": job.run_env in RUNNABLE_ENVS} for job in level]})
+    downstream = [job for level in levels[1:] for job in level]
+    return {"root": root.name,
+            "levels": plan_levels,
+            "total_jobs": len(downstream) + 1,
+            "max_fan_out": max([len(level) for level in levels[1:]] or [0]),
+            "critical_path_length": len(levels),
+            "masters": dict(Counter(job.run_env for job in downstream if job.run_env in RUNNABLE_ENVS))}
+
+
+def create_plan_orders(root, order_name, desc=None):
+    """
+    为整个执行计划创建订单，调用方负责在同一个事务中提交。
+    下游订单名称与run_downstream一致，为 <上游订单名称>-<job名称>，run_downstream会直接使用这些订单。
+    订单状态为ORDER_PENDING，job启动后才改为ORDER_RUNNING，未启动的订单不会显示为运行中。
+    run_downstream只启动run_env在RUNNABLE_ENVS中的job，其他job及其下游不会运行，不为它们创建订单
+    :param root: Jobs对象
+    :param order_name: root订单名称
+    :param desc: root订单描述
+    :return: [Orders, ...]，按层级排列
+    """
+    orders = list()
+    order_by_job = dict()
+    for depth, level in enumerate(_levels(load_subtree(root.id))):
+        for job in level:
+            if depth and (job.run_env not in RUNNABLE_ENVS or job.parent_id not in order_by_job):
+                continue
+            if depth == 0:
+                order = Orders(id=make_uuid(), name=order_name, desc=desc, job_id=job.id, status=ORDER_PENDING)
+            else:
+                parent_order = order_by_job[job.parent_id]
+                order = Orders(id=make_uuid(), name=f"{parent_order.name}-{job.name}", job_id=job.id,
+                               parent_id=parent_order.id, status=ORDER_PENDING)
+            order_by_job[job.id] = order
+            orders.append(order)
+    db.session.add_all(orders)
+    return orders
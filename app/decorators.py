@@ -2,6 +2,7 @@ from functools import wraps
 from flask import abort, request, make_response, session
 from . import logger
 from .common import false_return, exp_return, success_return
+from .ip_allowlist import client_ip
 from flask import make_response
 
 
@@ -21,7 +22,7 @@ def allow_cross_domain(fun):
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        logger.info(
+        logger.debug(
             'IP {} is checking login status'.format(
                 request.headers.get('X-Forwarded-For', request.remote_addr)))
         if not identify(request).get('code') == "success":
@@ -43,15 +44,21 @@ def permission_required(permission):
     return decorator
 
 
-def permission_ip(permission_ip_list):
+def permission_ip(permission_ip_list, trusted_proxies=None):
+    """
+    :param permission_ip_list: IPAllowlist，或任何支持in判断的IP集合
+    :param trusted_proxies: IPAllowlist，解析X-Forwarded-For时跳过的代理
+    """
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            logger.info(
-                'IP {} is trying to get the api'.format(
-                    request.headers.get('X-Forwarded-For', request.remote_addr)))
-            if request.headers.get('X-Forwarded-For', request.remote_addr) not in permission_ip_list:
-                abort(make_response(false_return(message='IP ' + request.remote_addr + ' not permitted')), 403)
+            # ProxyFix会用X-Forwarded-For改写REMOTE_ADDR，取改写前的TCP对端地址
+            remote_addr = request.environ.get('werkzeug.proxy_fix.orig', dict()).get(
+                'REMOTE_ADDR', request.environ.get('REMOTE_ADDR'))
+            ip = client_ip(request.headers.getlist('X-Forwarded-For'), remote_addr, trusted_proxies)
+            logger.info('IP {} is trying to get the api'.format(ip))
+            if ip is None or ip not in permission_ip_list:
+                abort(make_response(false_return(message='IP ' + str(ip) + ' not permitted'), 403))
             return f(*args, **kwargs)
 
         return decorated_function
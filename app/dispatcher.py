@@ -0,0 +1,95 @@
+from . import work_q, redis_db, db, logger
+from .common import session_commit, false_return
+from .models import make_uuid, REDIS_24H
+from .public_method import run_downstream
+from .metrics import observe_queues
+import threading
+import datetime
+import traceback
+import queue
+import json
+
+
+class DispatchPool:
+    """
+    消费work_q的下游任务派发线程池。orders接口只负责入队，由worker线程执行run_downstream，
+    任务状态写入Redis，多个进程都可以查询
+    """
+
+    def __init__(self, task_queue=work_q):
+        self.queue = task_queue
+        self.app = None
+        self.workers = list()
+
+    def init_app(self, app):
+        self.app = app
+        # work_q在导入时创建，这里按配置调整其深度
+        self.queue.maxsize = app.config.get('DISPATCH_QUEUE_SIZE', self.queue.maxsize)
+        for i in range(app.config.get('DISPATCH_WORKERS', 0)):
+            worker = threading.Thread(target=self._work, name=f"dispatch-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    @property
+    def enabled(self):
+        return bool(self.workers)
+
+    @staticmethod
+    def _task_key(task_id):
+        return f"dispatch::task::{task_id}"
+
+    def _set_status(self, task_id, status, **kwargs):
+        task = self.get_status(task_id) or {"task_id": task_id,
+                                             "create_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        task.update(kwargs)
+        task['status'] = status
+        task['update_at'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        redis_db.set(self._task_key(task_id), json.dumps(task, default=str), ex=REDIS_24H)
+
+    def get_status(self, task_id):
+        task = redis_db.get(self._task_key(task_id))
+        return json.loads(task) if task else None
+
+    def submit(self, **kwargs):
+        """
+        将run_downstream的参数入队
+        :param kwargs: run_downstream的参数
+        :return: task id
+        :raise queue.Full: 队列已满
+        """
+        task_id = make_uuid()
+        self._set_status(task_id, 'queued', order_id=kwargs.get('upstream_order_id'))
+        try:
+            self.queue.put_nowait({"task_id": task_id, "kwargs": kwargs})
+        except queue.Full:
+            redis_db.delete(self._task_key(task_id))
+            raise
+        observe_queues(work_q=self.queue)
+        return task_id
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            observe_queues(work_q=self.queue)
+            task_id = task['task_id']
+            try:
+                with self.app.app_context():
+                    self._set_status(task_id, 'running')
+                    result = run_downstream(**task['kwargs'])
+                    commit_result = session_commit()
+                    # 提交失败时session_commit返回(false_return, 400)
+                    if isinstance(commit_result, tuple):
+                        commit_result = commit_result[0]
+                    if commit_result.get('code') != 'success':
+                        result = false_return(message=f"db commit failed, {commit_result.get('message')}")
+                    self._set_status(task_id, 'success' if result.get('code') == 'success' else 'failed',
+                                     result=result)
+            except Exception as e:
+                traceback.print_exc()
+                logger.error(f"dispatch task {task_id} failed, {e}")
+                self._set_status(task_id, 'failed', result=false_return(message=str(e)))
+            finally:
+                self.queue.task_done()
+
+
+dispatch_pool = DispatchPool()
@@ -2,10 +2,12 @@ import jwt
 import datetime
 import time
 from ..models import NewCustomerAwards, LoginInfo, Customers, SceneInvitation, NEW_ONE_SCORES, SHARE_AWARD, make_uuid, \
-    Franchisees, CustomerRoles, FranchiseeOperators, BusinessUnitEmployees, SKU, FranchiseeGroupPurchase
+    Franchisees, FranchiseeOperators, BusinessUnitEmployees, SKU, FranchiseeGroupPurchase
 from .. import db, logger, SECRET_KEY, redis_db
 from ..common import success_return, false_return, session_commit, submit_return
 from ..public_method import new_data_obj, create_member_card_by_invitation, get_table_data_by_id, query_coupon
+from ..session_cache import frontstage_sessions
+from ..role_registry import customer_role_id
 import json
 import traceback
 
@@ -104,26 +106,23 @@ def authenticate(login_ip, **kwargs):
             scene_invitation = kwargs.get('scene_invitation')
             if scene in ('new_franchisee', 'new_bu', 'new_franchisee_employee', 'new_bu_employee'):
                 logger.debug(f"scene is {scene}")
-                if redis_db.exists(scene_invitation):
-                    obj_id = redis_db.get(scene_invitation)
+                obj_id = redis_db.get_and_delete(scene_invitation)
+                if obj_id is not None:
                     logger.debug(f"scene invitation mapped to value {obj_id}")
-                    redis_db.delete(scene_invitation)
                     if scene == 'new_franchisee':
                         # bind to the franchisee
                         # 创建manager
-                        job_role = CustomerRoles.query.filter_by(name="FRANCHISEE_MANAGER").first()
                         new_employee = new_data_obj("FranchiseeOperators", **{"customer_id": customer.id,
                                                                               "name": "老板（本人）",
-                                                                              "job_desc": job_role.id,
+                                                                              "job_desc": customer_role_id("FRANCHISEE_MANAGER"),
                                                                               "franchisee_id": obj_id})
                         if not new_employee or (new_employee and not new_employee['status']):
                             logger.error("绑定加盟商失败")
                     elif scene == 'new_bu':
                         # bind to the bu
-                        job_role = CustomerRoles.query.filter_by(name="BU_MANAGER").first()
                         new_employee = new_data_obj("BusinessUnitEmployees", **{"customer_id": customer.id,
                                                                                 "name": "老板（本人）",
-                                                                                "job_desc": job_role.id,
+                                                                                "job_desc": customer_role_id("BU_MANAGER"),
                                                                                 "business_unit_id": obj_id})
                         if not new_employee or (new_employee and not new_employee['status']):
                             logger.error("绑定店铺失败")
@@ -140,9 +139,8 @@ def authenticate(login_ip, **kwargs):
                 else:
                     logger.error('invitation code error')
             elif scene in ("new_customer", "new_member"):
-                if redis_db.exists(scene_invitation):
-                    obj_id = redis_db.get(scene_invitation)
-                    redis_db.delete(scene_invitation)
+                obj_id = redis_db.get_and_delete(scene_invitation)
+                if obj_id is not None:
                     bu_customer_obj = Customers.query.get(obj_id)
                     if not bu_customer_obj:
                         logger.error(f"customer {obj_id} is not available")
@@ -159,12 +157,12 @@ def authenticate(login_ip, **kwargs):
             scene = kwargs.get('scene')
             scene_invitation = kwargs.get('scene_invitation')
             if scene == 'new_fgp':
-                if redis_db.exists(scene_invitation):
+                obj_value = redis_db.get_and_delete(scene_invitation)
+                if obj_value is not None:
                     logger.debug("new_fgp action")
-                    obj_json = json.loads(redis_db.get(scene_invitation))
+                    obj_json = json.loads(obj_value)
                     obj_id = obj_json['gp_id']
                     salesman_id = obj_json['salesman_id']
-                    redis_db.delete(scene_invitation)
                     gp_obj = FranchiseeGroupPurchase.query.get(obj_id)
                     sku_id = gp_obj.sku_id
                     sku = SKU.query.get(sku_id)
@@ -220,6 +218,7 @@ def authenticate(login_ip, **kwargs):
         # 查询并删除已经登陆的信息
         logged_in_info = customer.login_info.filter_by(platform="wechat", status=True).all()
         for lg in logged_in_info:
+            frontstage_sessions.invalidate(lg.token)
             db.session.delete(lg)
         db.session.flush()
 
@@ -285,6 +284,12 @@ def identify(request):
             result = false_return(message='请传递正确的验证头信息')
         else:
             auth_token = auth_token_arr[1]
+            session = frontstage_sessions.get(auth_token)
+            if session:
+                return success_return(data={"user_id": session['user_id'],
+                                            "login_info_id": session['login_info_id'],
+                                            "token": auth_token},
+                                      message='请求成功')
             if not LoginInfo.query.filter_by(token=auth_token).first():
                 return false_return(message='认证失败')
             payload = decode_auth_token(auth_token)
@@ -296,7 +301,11 @@ def identify(request):
                 else:
                     login_info = LoginInfo.query.filter_by(token=auth_token, customer=user.id).first()
                     if login_info and login_info.login_time == data['login_time']:
-                        result = success_return(data={"user": user, "login_info": login_info}, message='请求成功')
+                        frontstage_sessions.set(auth_token, payload['data']['exp'], user_id=user.id,
+                                       login_info_id=login_info.id)
+                        result = success_return(data={"user_id": user.id, "login_info_id": login_info.id,
+                                                      "token": auth_token},
+                                                message='请求成功')
                     else:
                         result = false_return(message='Token已更改，请重新登录获取')
             else:
@@ -0,0 +1,152 @@
+from . import redis_db, logger
+import ipaddress
+import threading
+import os
+
+
+class IPAllowlist:
+    """
+    从Redis列表加载的IP白名单，常驻内存。
+    单个地址放在集合中O(1)查找；网段按(版本, 前缀长度)分桶，查找时按桶掩码后查集合，
+    次数只与出现过的前缀长度个数有关。
+    后台线程订阅变更频道，同时按固定间隔轮询兜底，修改Redis后无需重启worker
+    """
+
+    def __init__(self, key, redis_client=redis_db, refresh_interval=30):
+        """
+        :param key: Redis列表名，元素可以是单个IP，也可以是CIDR网段
+        :param redis_client:
+        :param refresh_interval: 轮询间隔秒数
+        """
+        self.key = key
+        self.channel = f"{key}::changed"
+        self.redis = redis_client
+        self.refresh_interval = refresh_interval
+        self._exact = frozenset()
+        # {(version, prefixlen): {network_address_int, ...}}
+        self._networks = dict()
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _parse(self, entries):
+        exact = set()
+        networks = dict()
+        for entry in entries:
+            entry = entry.strip()
+            if not entry:
+                continue
+            try:
+                if '/' in entry:
+                    network = ipaddress.ip_network(entry, strict=False)
+                    if network.prefixlen == network.max_prefixlen:
+                        exact.add(network.network_address)
+                    else:
+                        networks.setdefault((network.version, network.prefixlen), set()).add(
+                            int(network.network_address))
+                else:
+                    exact.add(ipaddress.ip_address(entry))
+            except ValueError:
+                logger.error(f"invalid entry {entry} in {self.key}")
+        return frozenset(exact), networks
+
+    def reload(self):
+        """
+        从Redis重新加载。读取失败时保留上一次的数据
+        """
+        try:
+            entries = self.redis.lrange(self.key, 0, -1)
+        except Exception as e:
+            logger.error(f"load {self.key} failed, {e}")
+            return False
+        exact, networks = self._parse(entries)
+        # 整体替换引用，检查时无需加锁
+        self._exact, self._networks = exact, networks
+        self._loaded = True
+        logger.debug(f"{self.key} reloaded, {len(exact)} addresses, {sum(map(len, networks.values()))} networks")
+        return True
+
+    def publish_change(self):
+        """
+        修改Redis列表后调用，通知所有进程重新加载
+        """
+        return self.redis.publish(self.channel, 'reload')
+
+    def _watch(self):
+        pubsub = None
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.channel)
+                    # 订阅期间的变更可能错过，订阅成功后补一次加载
+                    self.reload()
+                # 收到通知立即加载，超时则按轮询加载
+                pubsub.get_message(timeout=self.refresh_interval)
+                self.reload()
+            except Exception as e:
+                logger.error(f"watch {self.channel} failed, {e}")
+                pubsub = None
+                threading.Event().wait(self.refresh_interval)
+
+    def _ensure_started(self):
+        # gunicorn fork之后线程不会被继承，按pid判断是否需要在当前进程重新启动
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if not self._loaded:
+                self.reload()
+            threading.Thread(target=self._watch, name=f"{self.key}-watcher", daemon=True).start()
+            self._pid = os.getpid()
+
+    def __contains__(self, ip):
+        return self.check(ip)
+
+    def check(self, ip):
+        """
+        :param ip: 字符串或ipaddress对象
+        :return: bool
+        """
+        self._ensure_started()
+        if not isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            try:
+                ip = ipaddress.ip_address(ip.strip())
+            except (ValueError, AttributeError):
+                return False
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if ip in self._exact:
+            return True
+        address = int(ip)
+        for (version, prefixlen), network_set in self._networks.items():
+            if version != ip.version:
+                continue
+            shift = ip.max_prefixlen - prefixlen
+            if (address >> shift) << shift in network_set:
+                return True
+        return False
+
+
+def client_ip(forwarded_for, remote_addr, trusted_proxies=None):
+    """
+    解析客户端地址。TCP对端地址remote_addr作为链的最右侧，只有对端是可信代理时才继续向左读取X-Forwarded-For，
+    从右向左取第一个不属于可信代理的地址；直连的客户端可以任意伪造X-Forwarded-For，不能直接使用
+    :param forwarded_for: X-Forwarded-For请求头的值列表，每个值可以包含逗号分隔的多个地址
+    :param remote_addr: TCP对端地址，ProxyFix改写前的REMOTE_ADDR
+    :param trusted_proxies: IPAllowlist，可信的反向代理，为None时直接返回remote_addr
+    :return: ipaddress对象，需要读取的地址无法解析时返回None
+    """
+    chain = [hop for value in forwarded_for or [] for hop in value.split(',') if hop.strip()]
+    chain.append(remote_addr or '')
+    ip = None
+    for hop in reversed(chain):
+        try:
+            ip = ipaddress.ip_address(hop.strip())
+        except ValueError:
+            return None
+        if trusted_proxies is None or not trusted_proxies.check(ip):
+            return ip
+    # 整条链都是可信代理时取最左侧的地址
+    return ip
@@ -0,0 +1,207 @@
+from kubernetes.client.rest import ApiException
+from kubernetes.watch import Watch
+from . import db, logger
+from .common import session_commit
+from .models import Orders, KubeMaster, ORDER_FAILED, ORDER_RUNNING, ORDER_COMPLETE
+from .pykube import KubeMgmt
+from .public_method import run_downstream
+from .dispatcher import dispatch_pool
+from .metrics import order_transition
+from .scheduler_leader import scheduler_leader
+import threading
+import traceback
+import queue
+import time
+import json
+import os
+
+
+class JobWatcher:
+    """
+    每个k8s master一个后台watch，使用一个长连接接收namespace下所有Job事件，断线后按resourceVersion续传。
+    job结束后批量更新对应Orders的状态，完成的订单自动派发下游任务。
+    每个worker都会启动线程，但只有持有scheduler_leader租约的worker建立watch，整个集群每个master一个watch
+    k8s job name 由run_job生成，格式为 <order.name>-<run_times>
+    """
+
+    def __init__(self, app, master, namespace='default', flush_interval=2, watch_timeout=300):
+        self.app = app
+        self.master = master
+        self.namespace = namespace
+        self.flush_interval = flush_interval
+        self.watch_timeout = watch_timeout
+        self.resource_version = None
+        # k8s job name -> 订单状态
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._watch_forever, name=f"job-watcher-{self.master}", daemon=True).start()
+        threading.Thread(target=self._flush_forever, name=f"job-watcher-flush-{self.master}", daemon=True).start()
+
+    @staticmethod
+    def job_status(job):
+        """
+        :return: 已结束的job返回订单状态，未结束返回None
+        """
+        for condition in (job.status.conditions or []) if job.status else []:
+            if condition.status != 'True':
+                continue
+            if condition.type == 'Complete':
+                return ORDER_COMPLETE
+            if condition.type == 'Failed':
+                return ORDER_FAILED
+        return None
+
+    def _collect(self, job):
+        status = self.job_status(job)
+        if status is not None:
+            with self._lock:
+                self._pending[job.metadata.name] = status
+
+    def _stream(self):
+        kube = KubeMgmt(self.master, self.namespace)
+        if self.resource_version is None:
+            # 首次启动或resourceVersion过期，先list一次补齐断线期间结束的job
+            job_list = kube.batch.list_namespaced_job(namespace=self.namespace)
+            for job in job_list.items:
+                self._collect(job)
+            self.resource_version = job_list.metadata.resource_version
+
+        for event in Watch().stream(kube.batch.list_namespaced_job, namespace=self.namespace,
+                                    resource_version=self.resource_version, timeout_seconds=self.watch_timeout):
+            if event['type'] == 'ERROR':
+                raw = event.get('raw_object') or {}
+                raise ApiException(status=raw.get('code'), reason=raw.get('message'))
+            job = event['object']
+            self.resource_version = job.metadata.resource_version
+            self._collect(job)
+            if not scheduler_leader.active:
+                return
+
+    def _watch_forever(self):
+        backoff = 1
+        while True:
+            if not scheduler_leader.active:
+                # 非leader期间的事件由leader处理，重新成为leader后先list补齐
+                self.resource_version = None
+                time.sleep(self.flush_interval)
+                continue
+            try:
+                self._stream()
+                backoff = 1
+                continue
+            except ApiException as e:
+                if e.status == 410:
+                    logger.info(f"watch {self.master} resource version {self.resource_version} expired, relist")
+                    self.resource_version = None
+                    continue
+                logger.error(f"watch jobs of {self.master} failed, {e}")
+            except Exception as e:
+                traceback.print_exc()
+                logger.error(f"watch jobs of {self.master} failed, {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception as e:
+                traceback.print_exc()
+                logger.error(f"update orders of {self.master} failed, {e}")
+
+    def _restore(self, pending):
+        # 处理失败的事件放回队列，下次flush重试；期间收到的同名job事件更新，保留新的
+        with self._lock:
+            for job_name, status in pending.items():
+                self._pending.setdefault(job_name, status)
+
+    @staticmethod
+    def _order_output(order):
+        """
+        与手动将订单置为完成时一致，订单的output作为下游任务的command_params
+        """
+        if isinstance(order.output, dict):
+            return order.output
+        try:
+            output = json.loads(order.output) if order.output else None
+        except ValueError:
+            output = None
+        return output if isinstance(output, dict) else dict()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+        if not pending:
+            return
+        try:
+            completed = self._update_orders(pending)
+        except Exception:
+            db.session.rollback()
+            self._restore(pending)
+            raise
+        if completed is None:
+            self._restore(pending)
+            return
+        logger.info(f"{self.master} jobs finished: {pending}")
+
+        for dispatch_kwargs in completed:
+            if dispatch_pool.enabled:
+                try:
+                    dispatch_pool.submit(**dispatch_kwargs)
+                    continue
+                except queue.Full:
+                    logger.error(f"dispatch queue is full, run downstream of {dispatch_kwargs['upstream_order_id']} now")
+            logger.info(run_downstream(**dispatch_kwargs))
+            session_commit()
+
+    def _update_orders(self, pending):
+        """
+        :return: 需要派发下游任务的参数列表，提交失败返回None
+        """
+        # k8s job name中的run_times需要是订单最近一次启动的值，旧的job事件不再更新订单。
+        # relist时同一订单可能有多次运行的job，按(订单名称, run_times)保留全部，不依赖事件顺序
+        runs = dict()
+        for job_name, status in pending.items():
+            order_name, _, run_times = job_name.rpartition('-')
+            if order_name and run_times.isdigit():
+                runs.setdefault(order_name, dict())[int(run_times)] = status
+        if not runs:
+            return list()
+
+        completed = list()
+        orders = db.session.query(Orders).with_for_update().filter(Orders.name.in_(list(runs.keys()))).all()
+        for order in orders:
+            status = runs[order.name].get((order.run_times or 0) - 1)
+            if order.status != ORDER_RUNNING or status is None:
+                continue
+            order_transition(order.status, status)
+            order.status = status
+            if status == ORDER_COMPLETE:
+                completed.append({"job_id": order.job_id, "upstream_order_id": order.id, "force": 0,
+                                  "command_params": self._order_output(order)})
+        commit_result = session_commit()
+        # 提交失败时session_commit返回(false_return, 400)
+        if not isinstance(commit_result, dict) or commit_result.get('code') != 'success':
+            return None
+        return completed
+
+
+def start_job_watchers(app):
+    """
+    为每个有kubeconfig的master启动JobWatcher，需在scheduler_leader.init_app之后调用
+    """
+    watchers = list()
+    if not app.config.get('JOB_WATCHER_ENABLED'):
+        return watchers
+    for master, config_file in KubeMaster.items():
+        if not os.path.exists(config_file):
+            logger.error(f"kube config of {master} does not exist, skip job watcher")
+            continue
+        watcher = JobWatcher(app, master, flush_interval=app.config.get('JOB_WATCHER_FLUSH_INTERVAL', 2))
+        watcher.start()
+        watchers.append(watcher)
+    return watchers
@@ -5,10 +5,13 @@ from . import jobs
 from .. import db, default_api, logger
 from ..common import success_return, false_return, session_commit, submit_return
 from werkzeug.datastructures import FileStorage
-from ..public_method import table_fields, new_data_obj
+from ..public_method import table_fields, new_data_obj, new_data_objs
 from ..decorators import permission_required
 from ..swagger import return_dict, head_parser, page_parser
 from ..public_method import get_table_data, get_table_data_by_id, upload_fdfs
+from ..public_parser import yaml_cache
+from ..dag_planner import build_plan, create_plan_orders
+from ..command_template import validate_upload
 from collections import defaultdict
 
 jobs_ns = default_api.namespace('jobs', path='/jobs',
@@ -33,10 +36,18 @@ update_job_parser.replace_argument('file', required=False, type=FileStorage, loc
 update_job_tags_parser = reqparse.RequestParser()
 update_job_tags_parser.add_argument('tag', type=list, help='更新指定JOB的tag，若需要更新，需全量重传', location='json')
 
+plan_parser = reqparse.RequestParser()
+plan_parser.add_argument('order_name', required=True, help='执行计划根订单名称，下游订单名称为<上游订单名称>-<job名称>')
+plan_parser.add_argument('desc', help='根订单描述')
+
 return_json = jobs_ns.model('ReturnRegister', return_dict)
 
 jobs_page_parser = page_parser.copy()
 jobs_page_parser.add_argument('name', help='name', location='args')
+jobs_page_parser.add_argument('match', choices=('contains', 'eq', 'prefix'), help='name的匹配方式，contains(默认) | eq | prefix',
+                                location='args')
+jobs_page_parser.add_argument('cursor', help='page=cursor时使用，上一页返回的next_cursor，第一页不传', location='args')
+jobs_page_parser.add_argument('with_total', help='page=cursor时传true返回近似总数', location='args')
 
 
 @jobs_ns.route('')
@@ -54,7 +65,8 @@ class QueryJobs(Resource):
             args['search']['name'] = args.get('name')
         return success_return(
             get_table_data(Jobs, args, removes=['creator_id', 'parent_id'],
-                           appends=['children', 'config_files', 'tags']),
+                           appends=['children', 'config_files', 'tags'],
+                           operators={'name': args.get('match') or 'contains'}),
             "请求成功")
 
     @jobs_ns.doc(body=register_parser)
@@ -73,6 +85,9 @@ class QueryJobs(Resource):
             seq = args.get('seq')
             parent_id = args.get('parent_id')
             upload_object = args.get('file')
+            if upload_object:
+                parent_obj = Jobs.query.get(parent_id) if parent_id else None
+                validate_upload(upload_object, name, parent_obj.name if parent_obj else None)
             # 当前没有用户认证的步骤，所以job name需要唯一
             new_job = new_data_obj("Jobs", **{"name": name})
             if not new_job.get('new_one'):
@@ -95,9 +110,10 @@ class QueryJobs(Resource):
             #         the_job.arguments.append(new_arguments.get('obj'))
 
             if upload_object:
-                file_store_path = upload_fdfs(upload_object)
+                file_store_path, checksum = upload_fdfs(upload_object)
                 new_config_file = new_data_obj("ConfigFiles", **{"filename": upload_object.filename,
                                                                  "storage": file_store_path,
+                                                                 "checksum": checksum,
                                                                  "job_id": the_job.id})
 
             return submit_return('Successfully created job',
@@ -117,7 +133,8 @@ class JobByName(Resource):
         args = defaultdict(dict)
         args['search']['name'] = kwargs['job_name']
         return success_return(data=get_table_data(Jobs, args, removes=['creator_id', 'parent_id'],
-                                                  appends=['children', 'config_files', 'tags']))
+                                                  appends=['children', 'config_files', 'tags'],
+                                                  operators={'name': 'eq'}))
 
     @jobs_ns.doc(body=update_job_parser)
     @jobs_ns.marshal_with(return_json)
@@ -139,19 +156,30 @@ class JobByName(Resource):
                         setattr(the_job, key, args.get(key))
                 elif key == "file" and args.get(key):
                     upload_object = args.get(key)
-                    file_store_path = upload_fdfs(upload_object)
+                    parent_id = args.get('parent_id') or the_job.parent_id
+                    parent_obj = Jobs.query.get(parent_id) if parent_id else None
+                    validate_upload(upload_object,
+                                    args.get('name') or the_job.name,
+                                    parent_obj.name if parent_obj else None,
+                                    {t.arg_name.name for t in the_job.tags} if the_job.tags else None)
+                    file_store_path, checksum = upload_fdfs(upload_object)
 
-                    # 将老的配置状态设置为0， 这样取值不会取到
-                    old_config = the_job.config_files.query.filter(ConfigFiles.status.__eq__(1),
-                                                                   ConfigFiles.delete_at.__eq__(None)).first()
-                    if old_config:
+                    # 将老的配置状态设置为0， 这样取值不会取到，同时清除其yaml缓存
+                    old_configs = ConfigFiles.query.filter(ConfigFiles.job_id.__eq__(the_job.id),
+                                                           ConfigFiles.status.__eq__(1),
+                                                           ConfigFiles.delete_at.__eq__(None)).all()
+                    for old_config in old_configs:
                         old_config.status = 0
                         db.session.add(old_config)
+                        yaml_cache.invalidate(old_config.storage)
 
                     # 关联新的配置文件
                     new_config_file = new_data_obj("ConfigFiles", **{"filename": upload_object.filename,
                                                                      "storage": file_store_path,
+                                                                     "checksum": checksum,
                                                                      "job_id": the_job.id})
+                    # 上传内容与旧配置相同时会取到刚停用的记录，需要重新启用
+                    new_config_file['obj'].status = 1
                 elif key == "name" and args.get(key):
                     if Jobs.query.filter_by(name=args.get(key)).first():
                         raise Exception('name conflict')
@@ -181,16 +209,13 @@ class JobTagsByName(Resource):
                 raise Exception(f'Job name {kwargs["job_name"]} does not exist.')
 
             tags = update_job_tags_parser.parse_args()
-            current_job['obj'].tags = []
-            tag_id = list()
-            for tag in tags["tag"]:
-                tag_name = new_data_obj("ArgNames", **{'name': tag['name']}).get('obj')
-                tag_map = new_data_obj("Arguments", **{'arg_name_id': tag_name.id, 'value': tag['value']}).get('obj')
-                if tag_name.id not in tag_id:
-                    current_job['obj'].tags.append(tag_map)
-                    tag_id.append(tag_name.id)
-                else:
-                    raise Exception('tag名称不可重复')
+            tag_names = [tag['name'] for tag in tags["tag"]]
+            if len(set(tag_names)) != len(tag_names):
+                raise Exception('tag名称不可重复')
+            arg_names = new_data_objs("ArgNames", [{'name': name} for name in tag_names])
+            tag_maps = new_data_objs("Arguments", [{'arg_name_id': arg_name['obj'].id, 'value': tag['value']}
+                                                   for arg_name, tag in zip(arg_names, tags["tag"])])
+            current_job['obj'].tags = [tag_map['obj'] for tag_map in tag_maps]
 
             return submit_return(f'Successfully updated job, job_name={kwargs["job_name"]}',
                                  'Failed to update job, db commit error')
@@ -207,3 +232,39 @@ class JobTagsByName(Resource):
         tags = Jobs.query.filter_by(name=kwargs['job_name']).first().tags
         return success_return({t.arg_name.name: t.value for t in tags}, "请求成功")
 
+
+@jobs_ns.route('/<string:job_name>/plan')
+@jobs_ns.param("job_name", "执行计划的根job name")
+class JobPlanByName(Resource):
+    @jobs_ns.marshal_with(return_json)
+    @permission_required("app.jobs.jobs_api.job_plan_by_name.get")
+    def get(self, **kwargs):
+        """
+        获取job及其所有下游job的执行计划，包括每层的并发数和关键路径长度
+        """
+        job = Jobs.query.filter_by(name=kwargs['job_name']).first()
+        if not job:
+            return false_return(message=f'Job name {kwargs["job_name"]} does not exist.'), 404
+        return success_return(build_plan(job), "请求成功")
+
+    @jobs_ns.doc(body=plan_parser)
+    @jobs_ns.marshal_with(return_json)
+    @permission_required("app.jobs.jobs_api.job_plan_by_name.post")
+    def post(self, **kwargs):
+        """
+        按执行计划在一个事务中创建所有订单，下游订单在上游完成后由run_downstream启动
+        """
+        try:
+            args = plan_parser.parse_args()
+            job = Jobs.query.filter_by(name=kwargs['job_name']).first()
+            if not job:
+                raise Exception(f'Job name {kwargs["job_name"]} does not exist.')
+            if Orders.query.filter_by(name=args['order_name']).first():
+                raise Exception(f'Order name {args["order_name"]} exist.')
+            orders = create_plan_orders(job, args['order_name'], args.get('desc'))
+            return submit_return('Successfully created plan orders',
+                                 'Failed to create plan orders, db commit error',
+                                 data=[{"id": o.id, "name": o.name} for o in orders])
+        except Exception as e:
+            logger.error(str(e))
+            return false_return(message=str(e)), 400
@@ -0,0 +1,236 @@
+"""
+异步日志：业务线程只把日志记录放入有界队列，由后台QueueListener线程批量写文件。
+本模块不依赖app包，bench_logging.py可以单独加载
+"""
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import logging
+import threading
+import itertools
+import atexit
+import queue
+import time
+import os
+
+LOG_FORMAT = '%(asctime)s - %(module)s-%(funcName)s - %(levelname)s - %(message)s'
+LOG_DATEFMT = '%m/%d/%Y %H:%M:%S'
+
+
+def parse_module_levels(value):
+    """
+    解析模块日志级别配置
+    :param value: "public_method:INFO,pykube:WARNING"
+    :return: {"public_method": 20, "pykube": 30}
+    """
+    levels = dict()
+    for item in (value or '').split(','):
+        if ':' not in item:
+            continue
+        module, level = item.split(':', 1)
+        levels[module.strip()] = logging.getLevelName(level.strip().upper())
+    return {k: v for k, v in levels.items() if isinstance(v, int)}
+
+
+class ModuleLevelFilter(logging.Filter):
+    """
+    按record.module过滤级别，并对DEBUG日志按调用位置抽样，每sample_rate条保留1条
+    """
+
+    def __init__(self, default_level=logging.DEBUG, module_levels=None, sample_rate=1):
+        super().__init__()
+        self.default_level = default_level
+        self.module_levels = module_levels or dict()
+        self.sample_rate = max(int(sample_rate), 1)
+        # (pathname, lineno) -> 计数器，itertools.count的next在GIL下是原子的
+        self._counters = dict()
+
+    def filter(self, record):
+        if record.levelno < self.module_levels.get(record.module, self.default_level):
+            return False
+        if record.levelno > logging.DEBUG or self.sample_rate == 1:
+            return True
+        counter = self._counters.get((record.pathname, record.lineno))
+        if counter is None:
+            counter = self._counters.setdefault((record.pathname, record.lineno), itertools.count())
+        return next(counter) % self.sample_rate == 0
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    队列满时丢弃INFO及以下的日志并计数，WARNING及以上最多阻塞block_timeout秒，不让日志拖慢请求。
+    丢弃的条数由监听线程定期以WARNING输出，并通知listeners
+    """
+
+    def __init__(self, log_queue, block_timeout=0.1):
+        super().__init__(log_queue)
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        # 回调函数，参数为上次汇报以来丢弃的条数，在监听线程中调用
+        self.listeners = list()
+        self.listener = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        # fork后监听线程不会被继承，子进程中重新启动
+        if self._pid == os.getpid() or self.listener is None:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.listener.restart()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # 标准实现会先完整format一次再copy记录，监听线程还要再format一次；这里只合并消息和异常文本
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """
+    emit只写入文件缓冲区，由监听线程每批调用一次flush_batch落盘
+    """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+    def close(self):
+        self.flush_batch()
+        super().close()
+
+
+class BatchQueueListener(QueueListener):
+    """
+    一次取出队列中积压的日志(最多batch_size条)，处理后每个handler只flush一次。
+    每report_interval秒检查一次queue_handler丢弃的条数，有新增时直接写出一条WARNING，不经过队列
+    """
+
+    def __init__(self, log_queue, *handlers, batch_size=500, queue_handler=None, report_interval=60):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.queue_handler = queue_handler
+        self.report_interval = report_interval
+        self._reported = 0
+        self._reported_at = time.monotonic()
+
+    def report_dropped(self):
+        self._reported_at = time.monotonic()
+        if self.queue_handler is None:
+            return
+        dropped = self.queue_handler.dropped
+        count = dropped - self._reported
+        if count <= 0:
+            return
+        self._reported = dropped
+        self.handle(logging.LogRecord(__name__, logging.WARNING, __file__, 0,
+                                      f"log queue full, {count} records dropped ({dropped} since start)",
+                                      None, None, 'report_dropped'))
+        for listener in self.queue_handler.listeners:
+            try:
+                listener(count)
+            except Exception:
+                pass
+
+    def _flush(self):
+        for handler in self.handlers:
+            if hasattr(handler, 'flush_batch'):
+                handler.flush_batch()
+            else:
+                handler.flush()
+
+    def _monitor(self):
+        q = self.queue
+        stopping = False
+        while not stopping:
+            batch = list()
+            try:
+                # 空闲时也按report_interval醒来汇报丢弃的条数
+                batch.append(q.get(timeout=self.report_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(q.get_nowait())
+            except queue.Empty:
+                pass
+            for record in batch:
+                if record is self._sentinel:
+                    stopping = True
+                    continue
+                self.handle(record)
+            for _ in batch:
+                q.task_done()
+            if stopping or time.monotonic() - self._reported_at >= self.report_interval:
+                self.report_dropped()
+            self._flush()
+
+    def enqueue_sentinel(self):
+        # 有界队列满时等待监听线程腾出位置
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        # atexit与手动调用可能重复stop
+        if self._thread is not None:
+            super().stop()
+
+    def restart(self):
+        self._thread = None
+        self.start()
+
+
+def setup_logging(logger, filename, level=logging.INFO, module_levels=None, sample_rate=1, queue_size=10000,
+                  max_bytes=100 * 1024 * 1024, backup_count=10, console=True, drop_report_interval=60):
+    """
+    为logger配置异步日志
+    :param logger:
+    :param filename: 日志文件
+    :param level: 默认级别
+    :param module_levels: 按模块设置的级别，{module: level}
+    :param sample_rate: DEBUG日志抽样比例，每N条保留1条
+    :param queue_size: 队列长度，满时丢弃INFO及以下的日志
+    :param max_bytes: 单个日志文件大小
+    :param backup_count: 保留的轮转文件个数
+    :param console: 是否同时输出到stderr
+    :param drop_report_interval: 汇报丢弃日志条数的间隔秒数
+    :return: BoundedQueueHandler
+    """
+    formatter = logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATEFMT)
+    handlers = list()
+    file_handler = BufferedRotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count,
+                                               encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    handlers.append(file_handler)
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(fmt='%(asctime)s %(message)s', datefmt=LOG_DATEFMT))
+        handlers.append(console_handler)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = BoundedQueueHandler(log_queue)
+    module_levels = module_levels or dict()
+    queue_handler.addFilter(ModuleLevelFilter(level, module_levels, sample_rate))
+    queue_handler.listener = BatchQueueListener(log_queue, *handlers, queue_handler=queue_handler,
+                                                report_interval=drop_report_interval)
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    # logger级别取最低的配置，低于它的调用在logger.debug入口直接返回
+    logger.setLevel(min([level] + list(module_levels.values())))
+
+    queue_handler.listener.start()
+    atexit.register(queue_handler.listener.stop)
+    return queue_handler
@@ -0,0 +1,85 @@
+"""
+派发链路的Prometheus指标。
+gunicorn多进程部署时需要设置环境变量prometheus_multiproc_dir指向一个每次启动前清空的目录，
+并在gunicorn的child_exit钩子中调用prometheus_client.multiprocess.mark_process_dead(worker.pid)；
+未设置时指标只在当前进程内聚合
+"""
+from prometheus_client import Counter, Histogram, Gauge, CollectorRegistry, REGISTRY, generate_latest, \
+    CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from sqlalchemy.pool import QueuePool
+import time
+import os
+
+MULTIPROCESS = bool(os.environ.get('prometheus_multiproc_dir'))
+
+# fan-out宽度，即一次run_downstream启动的下游job个数
+DOWNSTREAM_FANOUT = Histogram('algodispatch_downstream_fanout', 'Number of child jobs started by one run_downstream',
+                              buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128))
+
+# run_job各阶段耗时，stage: yaml_fetch, render, k8s_create
+RUN_JOB_SECONDS = Histogram('algodispatch_run_job_seconds', 'run_job latency by stage', ['stage'],
+                            buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+
+KUBE_JOB_CREATE = Counter('algodispatch_kube_job_create_total', 'K8s job creations by master and result',
+                          ['master', 'result'])
+
+ORDER_STATUS_TRANSITIONS = Counter('algodispatch_order_status_transitions_total', 'Order status transitions',
+                                   ['from_status', 'to_status'])
+
+QUEUE_DEPTH = Gauge('algodispatch_queue_depth', 'In-process queue depth', ['queue'], multiprocess_mode='livesum')
+
+DB_POOL_CHECKOUT_WAIT = Histogram('algodispatch_db_pool_checkout_wait_seconds', 'Time spent waiting for a DB '
+                                  'connection from the pool',
+                                  buckets=(.0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+
+SCHEDULER_JOB_RUNS = Counter('algodispatch_scheduler_job_runs_total', 'Scheduled job runs by result', ['job', 'result'])
+
+SCHEDULER_JOB_LAST_DURATION = Gauge('algodispatch_scheduler_job_last_duration_seconds',
+                                    'Duration of the last run of a scheduled job', ['job'], multiprocess_mode='max')
+
+# 所有worker求和应为1
+SCHEDULER_LEADER = Gauge('algodispatch_scheduler_leader', 'Whether this worker holds the scheduler lease',
+                         multiprocess_mode='livesum')
+
+# 异步日志队列满时丢弃的记录数，由日志监听线程每LOG_DROP_REPORT_INTERVAL秒累加一次
+LOG_RECORDS_DROPPED = Counter('algodispatch_log_records_dropped_total',
+                              'Log records dropped because the async log queue was full')
+
+
+class TimedQueuePool(QueuePool):
+    """
+    记录从连接池取连接的等待时间，通过SQLALCHEMY_ENGINE_OPTIONS的poolclass启用
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start)
+
+
+def order_transition(old_status, new_status):
+    if old_status != new_status:
+        ORDER_STATUS_TRANSITIONS.labels(str(old_status), str(new_status)).inc()
+
+
+def observe_queues(**queues):
+    """
+    :param queues: {name: queue.Queue}
+    """
+    for name, q in queues.items():
+        QUEUE_DEPTH.labels(name).set(q.qsize())
+
+
+def render_metrics():
+    """
+    :return: (body, content type)
+    """
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,4 +1,5 @@
 from app import db, redis_db
+from .ip_allowlist import IPAllowlist
 import datetime
 import os
 import uuid
@@ -9,6 +10,23 @@ def make_uuid():
     return str(uuid.uuid4())
 
 
+def get_model(table):
+    """
+    通过类名获取model类，替代eval
+    :param table: 类名或者model类
+    :return: model类
+    """
+    if isinstance(table, type):
+        return table
+    registry = getattr(db.Model, '_decl_class_registry', None)
+    if registry is None:
+        registry = db.Model.registry._class_registry
+    model = registry.get(table)
+    if not isinstance(model, type):
+        raise Exception(f"model {table} does not exist")
+    return model
+
+
 def make_order_id(prefix=None):
     """
     生成订单号
@@ -65,6 +83,8 @@ class Orders(db.Model):
     update_at = db.Column(db.DateTime, onupdate=datetime.datetime.now)
     delete_at = db.Column(db.DateTime)
 
+    __table_args__ = (db.Index('ix_orders_create_at_id', 'create_at', 'id'),)
+
 
 class Jobs(db.Model):
     __tablename__ = 'jobs'
@@ -97,6 +117,8 @@ class Jobs(db.Model):
 
     orders = db.relationship('Orders', backref='related_jobs', lazy='dynamic')
 
+    __table_args__ = (db.Index('ix_jobs_create_at_id', 'create_at', 'id'),)
+
 
 class SMSTemplate(db.Model):
     __tablename__ = 'sms_template'
@@ -133,6 +155,7 @@ class ConfigFiles(db.Model):
     id = db.Column(db.String(64), primary_key=True, default=make_uuid)
     filename = db.Column(db.String(100), index=True)
     storage = db.Column(db.String(200), index=True)
+    checksum = db.Column(db.String(64), index=True, comment='文件内容sha256，用于上传去重')
     job_id = db.Column(db.String(64), db.ForeignKey('jobs.id'))
     status = db.Column(db.SmallInteger, default=1, comment='1,正常，0, 停用')
     create_at = db.Column(db.DateTime, default=datetime.datetime.now)
@@ -159,13 +182,51 @@ RECHARGE_REBATE_POLICY = 3
 
 FIRST_PAGE_POPUP_URL = "IMAGE"
 
-PermissionIP = redis_db.lrange('permission_ip', 0, -1)
+# IP白名单刷新间隔秒数，修改后通过permission_ip::changed频道通知可立即生效
+PERMISSION_IP_REFRESH_INTERVAL = 30
+
+# 订单支付超时时间；超时扫描每批处理的订单数；扫描锁的过期秒数，需大于一次扫描的最长耗时
+ORDER_PAY_TIMEOUT = datetime.timedelta(hours=48)
+CHECK_ORDERS_CHUNK = 200
+CHECK_ORDERS_LOCK_EXPIRE = 300
+
+# 返佣比例索引检查Redis版本号的间隔秒数
+REBATE_RATE_CHECK_INTERVAL = 5
+
+# Orders.status。执行计划预先创建的订单为ORDER_PENDING，job在k8s中创建成功后改为ORDER_RUNNING
+ORDER_FAILED = 0
+ORDER_RUNNING = 1
+ORDER_COMPLETE = 2
+ORDER_PENDING = 3
+
+PermissionIP = IPAllowlist('permission_ip', refresh_interval=PERMISSION_IP_REFRESH_INTERVAL)
+
+# 可信的反向代理，解析X-Forwarded-For时跳过
+TrustedProxies = IPAllowlist('trusted_proxy', refresh_interval=PERMISSION_IP_REFRESH_INTERVAL)
 
 PATH_PREFIX = os.path.abspath(os.path.dirname(__file__))
 
 KubeMaster = {'k8sm01': os.path.join(PATH_PREFIX, "conf/k8sm01_admin.yaml"),
               'k8sm02': os.path.join(PATH_PREFIX, "conf/k8sm02_admin.yaml")}
 
+# 每个k8s master同时创建job的并发上限，未配置的master使用KUBE_DEFAULT_CONCURRENCY
+KubeMasterConcurrency = {'k8sm01': 8,
+                         'k8sm02': 8}
+
+KUBE_DEFAULT_CONCURRENCY = 4
+
+# 创建k8s job遇到409/429/5xx时的重试次数，以及退避的初始、最大等待秒数
+KUBE_CREATE_RETRIES = 3
+KUBE_RETRY_BASE_DELAY = 0.5
+KUBE_RETRY_MAX_DELAY = 8
+
+# 进程内缓存的已解析job yaml数量，以及是否使用Redis作为二级缓存
+YAML_CACHE_SIZE = 256
+YAML_CACHE_REDIS = True
+
+# run_downstream默认是否使用线程池并发启动下游job
+DOWNSTREAM_PARALLEL = True
+
 CERT_PATH = PATH_PREFIX + '/cert/apiclient_cert.pem'
 
 KEY_PATH = PATH_PREFIX + '/cert/apiclient_key.pem'
@@ -183,3 +244,13 @@ SHARE_AWARD = 0
 REDIS_LONG_EXPIRE = 1800
 REDIS_24H = 86400
 REDIS_SHORT_EXPIRE = 300
+
+# contains搜索使用MySQL FULLTEXT索引的字段，格式为"表名.字段名"，例如"orders.name"，需要先建立FULLTEXT索引
+FULLTEXT_COLUMNS = set()
+
+# 上传文件到FastDFS时每次读取的字节数
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 游标分页默认每页行数，以及近似总数的缓存时间
+KEYSET_DEFAULT_SIZE = 20
+KEYSET_COUNT_EXPIRE = 60
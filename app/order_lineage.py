@@ -0,0 +1,66 @@
+from sqlalchemy import literal
+from sqlalchemy.orm import aliased
+from collections import defaultdict
+from . import db
+from .models import Orders
+from .public_method import table_fields, _make_table
+
+# 递归查询的最大深度，防止parent_id数据错误形成环
+MAX_LINEAGE_DEPTH = 100
+
+
+def load_lineage_rows(order_id, direction='down', max_depth=None):
+    """
+    使用一次WITH RECURSIVE查询取出订单的所有下游或上游订单
+    :param order_id: Orders.id
+    :param direction: down 下游 | up 上游
+    :param max_depth: 最大深度，不传则为MAX_LINEAGE_DEPTH
+    :return: [(order, depth), ...]，起始订单的depth为0
+    """
+    max_depth = MAX_LINEAGE_DEPTH if max_depth is None else min(max_depth, MAX_LINEAGE_DEPTH)
+    related = aliased(Orders)
+    lineage = db.session.query(Orders.id.label('id'), Orders.parent_id.label('parent_id'), literal(0).label('depth')) \
+        .filter(Orders.id.__eq__(order_id)).cte(name='order_lineage', recursive=True)
+    if direction == 'up':
+        join_condition = related.id.__eq__(lineage.c.parent_id)
+    else:
+        join_condition = related.parent_id.__eq__(lineage.c.id)
+    lineage = lineage.union_all(
+        db.session.query(related.id, related.parent_id, lineage.c.depth + 1)
+            .filter(join_condition, lineage.c.depth.__lt__(max_depth)))
+    return db.session.query(Orders, lineage.c.depth).join(lineage, Orders.id.__eq__(lineage.c.id)) \
+        .order_by(lineage.c.depth, Orders.create_at).all()
+
+
+def build_lineage(order, direction='down', max_depth=None, status=None):
+    """
+    在内存中把lineage组装为嵌套结构。down方向下游放在children中，up方向上游放在parent中
+    :param status: 仅down方向有效，只返回此状态的订单以及通往它们的路径上的订单，起始订单始终返回
+    :return: dict
+    """
+    rows = load_lineage_rows(order.id, direction, max_depth)
+    fields = table_fields(Orders, [], [])
+    nodes = dict()
+    for o, depth in rows:
+        node = _make_table(fields, o)
+        node['depth'] = depth
+        nodes[o.id] = node
+
+    if direction == 'up':
+        for o, _ in rows:
+            if o.parent_id in nodes:
+                nodes[o.id]['parent'] = nodes[o.parent_id]
+        return nodes[order.id]
+
+    children = defaultdict(list)
+    for o, depth in rows:
+        if depth:
+            children[o.parent_id].append(o.id)
+
+    # 按depth从深到浅组装，不使用递归；被过滤掉的订单若有符合条件的下游，仍作为路径保留
+    kept = dict()
+    for o, depth in reversed(rows):
+        node = nodes[o.id]
+        node['children'] = [nodes[child_id] for child_id in children[o.id] if kept[child_id]]
+        kept[o.id] = status is None or node['status'] == status or bool(node['children'])
+    return nodes[order.id]
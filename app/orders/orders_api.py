@@ -8,7 +8,11 @@ from ..public_method import table_fields, new_data_obj
 from ..decorators import permission_required
 from ..swagger import return_dict, head_parser, page_parser
 from ..public_method import get_table_data, get_table_data_by_id, upload_fdfs, run_downstream
+from ..dispatcher import dispatch_pool
+from ..order_lineage import build_lineage
+from ..metrics import order_transition
 from collections import defaultdict
+import queue
 
 orders_ns = default_api.namespace('orders', path='/orders', description='任务执行的记录，包括其状态等')
 
@@ -23,11 +27,22 @@ register_parser.add_argument('force', type=int, help='强制执行下游任务
 update_job_parser = register_parser.copy()
 update_job_parser.replace_argument('name', required=False, help='任务名称')
 
+lineage_parser = reqparse.RequestParser()
+lineage_parser.add_argument('direction', choices=('down', 'up'), default='down', help='down：下游订单（默认）；up：上游订单',
+                            location='args')
+lineage_parser.add_argument('depth', type=int, help='最大层级，不传则不限制', location='args')
+lineage_parser.add_argument('status', type=int, help='只返回此状态的订单及其路径，0：失败，1：正在运行，2：完成，3：已创建未启动',
+                            location='args')
+
 return_json = orders_ns.model('ReturnRegister', return_dict)
 
 orders_page_parser = page_parser.copy()
 orders_page_parser.add_argument('name', help='根据执行订单名称来查询', location='args')
 orders_page_parser.add_argument('job_name', help='查询此任务名称对应的所有执行订单', location='args')
+orders_page_parser.add_argument('match', choices=('contains', 'eq', 'prefix'),
+                                help='name的匹配方式，contains(默认) | eq | prefix', location='args')
+orders_page_parser.add_argument('cursor', help='page=cursor时使用，上一页返回的next_cursor，第一页不传', location='args')
+orders_page_parser.add_argument('with_total', help='page=cursor时传true返回近似总数', location='args')
 
 
 @orders_ns.route('')
@@ -44,13 +59,15 @@ class QueryOrders(Resource):
         if args.get("name"):
             args['search']['name'] = args.get('name')
         if args.get('job_name'):
-            job = Jobs.query.filter_by(name=args.get('name')).first()
+            job = Jobs.query.filter_by(name=args.get('job_name')).first()
             if job:
                 args['search']['job_id'] = job.id
             else:
                 logger.error(f'Query orders by job name {args.get("job_name")} failed for the name does not exist!')
                 return success_return({})
-        return success_return(get_table_data(Orders, args, appends=['children'], removes=['job_id', 'parent_id']), "请求成功")
+        return success_return(get_table_data(Orders, args, appends=['children'], removes=['job_id', 'parent_id'],
+                                             operators={'name': args.get('match') or 'contains', 'job_id': 'eq'}),
+                              "请求成功")
 
     @orders_ns.doc(body=register_parser)
     @orders_ns.marshal_with(return_json)
@@ -79,22 +96,36 @@ class QueryOrders(Resource):
 
             the_order = new_order.get('obj')
             the_order.desc = desc
+            order_transition('new' if new_order.get('new_one') else the_order.status, status)
             the_order.status = status
             if new_order.get('new_one'):
                 the_order.job_id = job_id
                 the_order.output = output
 
             run_results = dict()
+            dispatch_kwargs = dict()
             if status == 2:
                 # 如果是2，表示complete，查找下游任务并开始
                 if force == 1 or the_order.run_times == 0:
-                    run_results = run_downstream(job_id=job_id,
-                                                 upstream_order_id=the_order.id,
-                                                 force=force,
-                                                 command_params=output)
+                    dispatch_kwargs = {"job_id": job_id,
+                                       "upstream_order_id": the_order.id,
+                                       "force": force,
+                                       "command_params": output}
+                    if not dispatch_pool.enabled:
+                        run_results = run_downstream(**dispatch_kwargs)
                     the_order.run_times += 1
 
             if session_commit().get("code") == "success":
+                if dispatch_kwargs and dispatch_pool.enabled:
+                    # 订单已提交，下游任务交给派发线程池执行
+                    try:
+                        task_id = dispatch_pool.submit(**dispatch_kwargs)
+                    except queue.Full:
+                        the_order.run_times -= 1
+                        session_commit()
+                        return false_return(message='dispatch queue is full, please retry later'), 429
+                    return success_return({"id": the_order.id, "task_id": task_id},
+                                          'Downstream jobs queued, query the task for result')
                 if run_results:
                     if run_results.get('code') == 'success':
                         return success_return({"id": the_order.id, "child_job": run_results['data']},
@@ -121,4 +152,38 @@ class QueryByName(Resource):
         """
         args = defaultdict(dict)
         args['search']['name'] = kwargs['order_name']
-        return success_return(get_table_data(Orders, args, appends=['children'], removes=['job_id', 'parent_id']), "请求成功")
\ No newline at end of file
+        return success_return(get_table_data(Orders, args, appends=['children'], removes=['job_id', 'parent_id'],
+                                             operators={'name': 'eq'}), "请求成功")
+
+
+@orders_ns.route('/<string:order_name>/lineage')
+@orders_ns.param("order_name", "order name")
+class OrderLineage(Resource):
+    @orders_ns.marshal_with(return_json)
+    @permission_required("app.orders.orders_api.order_lineage.get")
+    @orders_ns.expect(lineage_parser)
+    def get(self, **kwargs):
+        """
+        获取订单的整棵下游（或上游）订单树
+        """
+        args = lineage_parser.parse_args()
+        order = Orders.query.filter_by(name=kwargs['order_name']).first()
+        if not order:
+            return false_return(message=f"order {kwargs['order_name']} does not exist"), 404
+        return success_return(build_lineage(order, args['direction'], args.get('depth'), args.get('status')),
+                              "请求成功")
+
+
+@orders_ns.route('/tasks/<string:task_id>')
+@orders_ns.param("task_id", "创建订单时返回的task_id")
+class DispatchTask(Resource):
+    @orders_ns.marshal_with(return_json)
+    @permission_required("app.orders.orders_api.dispatch_task.get")
+    def get(self, **kwargs):
+        """
+        查询下游任务派发结果，status: queued | running | success | failed
+        """
+        task = dispatch_pool.get_status(kwargs['task_id'])
+        if not task:
+            return false_return(message=f"task {kwargs['task_id']} does not exist"), 404
+        return success_return(task, "请求成功")
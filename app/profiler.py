@@ -0,0 +1,138 @@
+from flask import request, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import logger, redis_db
+from .pykube import kube_clients
+import traceback
+import threading
+import datetime
+import heapq
+import json
+import time
+import os
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 统计类别，顺序即Server-Timing中的顺序
+CATEGORIES = ('db', 'redis', 'k8s')
+
+
+class SlowStatements:
+    """
+    进程内最慢的top_n条SQL，小顶堆，超过阈值才会进入
+    """
+
+    def __init__(self, top_n=20, threshold=0.1):
+        self.top_n = top_n
+        self.threshold = threshold
+        self._heap = list()
+        # 相同耗时时用序号比较，避免比较dict
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def add(self, elapsed, statement, parameters):
+        if elapsed < self.threshold:
+            return
+        # 只保留app目录下的调用栈，排除本模块
+        stack = [f"{os.path.relpath(frame.filename, APP_DIR)}:{frame.lineno} {frame.name}"
+                 for frame in traceback.extract_stack()
+                 if frame.filename.startswith(APP_DIR) and frame.filename != __file__]
+        entry = {"elapsed_ms": round(elapsed * 1000, 3),
+                 "statement": statement,
+                 "parameters": str(parameters)[:500],
+                 "stack": stack[-10:],
+                 "path": request.path if request else None,
+                 "at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        with self._lock:
+            self._seq += 1
+            item = (elapsed, self._seq, entry)
+            if len(self._heap) < self.top_n:
+                heapq.heappush(self._heap, item)
+            elif elapsed > self._heap[0][0]:
+                heapq.heapreplace(self._heap, item)
+
+    def snapshot(self):
+        with self._lock:
+            return [entry for _, _, entry in sorted(self._heap, key=lambda x: x[0], reverse=True)]
+
+    def clear(self):
+        with self._lock:
+            self._heap = list()
+
+
+class RequestProfiler:
+    """
+    请求级的SQL、Redis、k8s调用次数及耗时统计，通过PROFILER_ENABLED开启。
+    统计保存在线程局部变量中，请求结束时写入Server-Timing响应头和结构化日志；
+    派发worker、watcher等非请求线程的调用不计入
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_statements = SlowStatements()
+        self._local = threading.local()
+
+    def init_app(self, app):
+        if not app.config.get('PROFILER_ENABLED'):
+            return
+        self.enabled = True
+        self.slow_statements.top_n = app.config.get('PROFILER_TOP_N', 20)
+        self.slow_statements.threshold = app.config.get('PROFILER_SLOW_MS', 100) / 1000
+
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        redis_db.stats.listeners.append(lambda command, elapsed: self.record('redis', elapsed))
+        kube_clients.listeners.append(lambda method, elapsed: self.record('k8s', elapsed))
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+
+    @property
+    def current(self):
+        return getattr(self._local, 'stats', None)
+
+    def record(self, category, elapsed):
+        stats = self.current
+        if stats is not None:
+            stats[category][0] += 1
+            stats[category][1] += elapsed
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profiler_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['profiler_start'].pop()
+        self.record('db', elapsed)
+        if self.current is not None:
+            self.slow_statements.add(elapsed, statement, parameters)
+
+    def _start(self):
+        self._local.stats = {category: [0, 0.0] for category in CATEGORIES}
+        g.profiler_start = time.perf_counter()
+
+    def _finish(self, response):
+        stats = self.current
+        if stats is None:
+            return response
+        total = time.perf_counter() - g.profiler_start
+        timings = [f'{category};dur={stats[category][1] * 1000:.1f};desc="{stats[category][0]} calls"'
+                   for category in CATEGORIES]
+        timings.append(f'total;dur={total * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+        logger.info(json.dumps({"event": "request_profile",
+                                "method": request.method,
+                                "path": request.path,
+                                "status": response.status_code,
+                                "total_ms": round(total * 1000, 3),
+                                **{f"{category}_count": stats[category][0] for category in CATEGORIES},
+                                **{f"{category}_ms": round(stats[category][1] * 1000, 3)
+                                   for category in CATEGORIES}}))
+        return response
+
+    def _teardown(self, exc=None):
+        self._local.stats = None
+
+
+profiler = RequestProfiler()
@@ -1,13 +1,22 @@
-from . import logger, fdfs_client
+from . import logger, fdfs_client, redis_db
 from .common import false_return, success_return, session_commit
 from .models import *
-from sqlalchemy import and_
+from sqlalchemy import and_, or_, inspect, tuple_, UniqueConstraint
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from collections import defaultdict
 import datetime
 import traceback
 from decimal import Decimal
 from app.pykube import KubeMgmt
-from app.public_parser import load_yaml
-import re
+from app.public_parser import get_yaml_storage, fetch_template
+from app.metrics import RUN_JOB_SECONDS, DOWNSTREAM_FANOUT, order_transition
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import hashlib
+import tempfile
+import json
 
 
 def format_decimal(num, zero_format="0.00", to_str=False):
@@ -29,13 +38,13 @@ def new_data_obj(table, **kwargs):
     :param kwargs: 表数据，需要对应表字段
     :return: 新增，或者已有数据的对象
     """
-    logger.debug(f">>> Check the {table} for data {kwargs}")
-    __obj = eval(table).query.filter_by(**kwargs).first()
+    model = get_model(table)
+    __obj = model.query.filter_by(**kwargs).first()
     new_one = True
     if not __obj:
-        logger.debug(f">>> The table {table} does not have the obj, create new one!")
+        logger.debug(f">>> The table {table} does not have the obj for {kwargs}, create new one!")
         try:
-            __obj = eval(table)(**kwargs)
+            __obj = model(**kwargs)
             db.session.add(__obj)
             db.session.flush()
         except Exception as e:
@@ -49,6 +58,90 @@ def new_data_obj(table, **kwargs):
     return {'obj': __obj, 'new_one': new_one}
 
 
+def _unique_keys(model):
+    """
+    model上的唯一键集合，每个元素是组成唯一键的字段名frozenset
+    """
+    table = model.__table__
+    unique_keys = {frozenset(c.name for c in table.primary_key.columns)}
+    unique_keys.update(frozenset([c.name]) for c in table.columns if c.unique)
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            unique_keys.add(frozenset(c.name for c in constraint.columns))
+    unique_keys.update(frozenset(c.name for c in index.columns) for index in table.indexes if index.unique)
+    return unique_keys
+
+
+def _coerce_key(column, value):
+    """
+    把key字段的值转换为字段类型。已有数据按数据库返回的值匹配，例如String字段传入5时数据库返回'5'
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if value is None or python_type not in (str, int, float, Decimal) or isinstance(value, python_type):
+        return value
+    return python_type(value)
+
+
+def new_data_objs(table, rows, keys=None):
+    """
+    批量创建数据对象，new_data_obj的批量版本。已有数据用一次IN查询取出，缺少的用一条多行insert写入，
+    MySQL上keys为唯一键时使用INSERT ... ON DUPLICATE KEY UPDATE，避免并发重复插入
+    :param table: 表名或model类
+    :param rows: [dict, ...]，表数据，需要对应表字段，且字段一致
+    :param keys: 判断数据是否已存在的字段，值不能为None，默认为rows中的全部字段
+    :return: 与rows顺序一致的[{'obj': obj, 'new_one': bool}, ...]
+    """
+    if not rows:
+        return []
+    model = get_model(table)
+    if keys is None:
+        keys = list(rows[0].keys())
+
+    def _query(wanted_keys):
+        if len(keys) == 1:
+            condition = getattr(model, keys[0]).in_([k[0] for k in wanted_keys])
+        else:
+            condition = tuple_(*[getattr(model, k) for k in keys]).in_(wanted_keys)
+        return {tuple(getattr(o, k) for k in keys): o for o in model.query.filter(condition).all()}
+
+    columns = model.__table__.columns
+    rows = [dict(row, **{k: _coerce_key(columns[k], row[k]) for k in keys}) for row in rows]
+    row_keys = [tuple(row[k] for k in keys) for row in rows]
+    existing = _query(list(dict.fromkeys(row_keys)))
+
+    missing = dict()
+    for row_key, row in zip(row_keys, rows):
+        if row_key not in existing and row_key not in missing:
+            missing[row_key] = row
+
+    created = dict()
+    if missing:
+        try:
+            if db.engine.dialect.name == 'mysql' and frozenset(keys) in _unique_keys(model):
+                stmt = mysql_insert(model.__table__).values(list(missing.values()))
+                stmt = stmt.on_duplicate_key_update({k: stmt.inserted[k] for k in keys})
+            else:
+                stmt = model.__table__.insert().values(list(missing.values()))
+            db.session.execute(stmt)
+        except Exception as e:
+            logger.error(f'bulk create {table} fail {e}')
+            traceback.print_exc()
+            db.session.rollback()
+            raise Exception(f"bulk create new records in {model.__name__} failed for {e}")
+        created = _query(list(missing.keys()))
+
+    result = [{'obj': existing.get(row_key) or created.get(row_key), 'new_one': row_key not in existing}
+              for row_key in row_keys]
+    not_found = [row_key for row_key, r in zip(row_keys, result) if r['obj'] is None]
+    if not_found:
+        db.session.rollback()
+        raise Exception(f"bulk create new records in {model.__name__} failed, {not_found} not found after insert")
+    return result
+
+
 def table_fields(table, appends: list, removes: list):
     original_fields = getattr(getattr(table, '__table__'), 'columns').keys()
     for a in appends:
@@ -70,11 +163,60 @@ def find_id(elements_list):
             return [el['id']]
 
 
-def _make_table(fields, table, strainer=None):
+def _loader_options(table, fields):
+    """
+    根据需要输出的字段生成relationship的批量加载选项，children和config_files由_preload单独处理
+    """
+    options = list()
+    relationships = inspect(table).relationships
+    for f in fields:
+        if f in ('children', 'config_files') or f not in relationships.keys():
+            continue
+        if f == 'tags':
+            options.append(selectinload(getattr(table, f)).joinedload(Arguments.arg_name))
+        else:
+            options.append(selectinload(getattr(table, f)))
+    return options
+
+
+def _preload(table, rows, fields):
+    """
+    批量加载_make_table需要的关联数据，查询次数与行数无关：
+    children按层级用IN查询加载并写入relationship，只与树的深度有关；
+    config_files用一次IN查询取出所有job当前生效的配置文件
+    :return: 供_make_table使用的预加载数据
+    """
+    preloaded = dict()
+    if not rows:
+        return preloaded
+    all_rows = list(rows)
+    if 'children' in fields and 'children' in inspect(table).relationships.keys():
+        options = _loader_options(table, fields)
+        level = list(rows)
+        seen = {r.id for r in level}
+        while level:
+            children = defaultdict(list)
+            for child in table.query.options(*options).filter(table.parent_id.in_([r.id for r in level])).all():
+                children[child.parent_id].append(child)
+            for r in level:
+                set_committed_value(r, 'children', children.get(r.id, []))
+            level = [c for cs in children.values() for c in cs if c.id not in seen]
+            seen.update(c.id for c in level)
+            all_rows.extend(level)
+    if 'config_files' in fields and table is Jobs:
+        config_fields = table_fields(ConfigFiles, [], [])
+        active_configs = ConfigFiles.query.filter(ConfigFiles.job_id.in_([r.id for r in all_rows]),
+                                                  ConfigFiles.status.__eq__(1),
+                                                  ConfigFiles.delete_at.__eq__(None)).all()
+        preloaded['config_files'] = {c.job_id: _make_table(config_fields, c) for c in active_configs}
+    return preloaded
+
+
+def _make_table(fields, table, strainer=None, preloaded=None):
     tmp = dict()
     for f in fields:
         if f == 'roles':
-            tmp[f] = [get_table_data_by_id(eval(role.__class__.__name__), role.id, ['elements']) for role in
+            tmp[f] = [get_table_data_by_id(role.__class__, role.id, ['elements']) for role in
                       table.roles]
         elif f == 'role':
             try:
@@ -88,9 +230,9 @@ def _make_table(fields, table, strainer=None):
                 for child in table.children:
                     if strainer is not None:
                         if child.type == strainer[0] and child.id in strainer[1]:
-                            child_tmp.extend(_make_data([child], fields, strainer))
+                            child_tmp.extend(_make_data([child], fields, strainer, preloaded))
                     else:
-                        child_tmp.extend(_make_data([child], fields, strainer))
+                        child_tmp.extend(_make_data([child], fields, strainer, preloaded))
                 tmp[f] = child_tmp
         elif f == 'objects':
             tmp1 = list()
@@ -119,10 +261,13 @@ def _make_table(fields, table, strainer=None):
         elif f == 'shop_order_verbose':
             if table.shop_order_id:
                 table_name = table.related_order.__class__.__name__
-                tmp[f] = get_table_data_by_id(eval(table_name), table.shop_order_id, appends=['real_payed_cash_fee'])
+                tmp[f] = get_table_data_by_id(get_model(table_name), table.shop_order_id, appends=['real_payed_cash_fee'])
         elif f == 'config_files':
-            if table.config_files:
-                table_obj = eval(table.config_files.__class__.__name__)
+            if preloaded is not None and 'config_files' in preloaded:
+                if table.id in preloaded['config_files']:
+                    tmp[f] = preloaded['config_files'][table.id]
+            elif table.config_files:
+                table_obj = table.config_files.__class__
                 tmp[f] = get_table_data_by_id(table_obj,
                                               table.config_files.id,
                                               advance_search=[
@@ -143,18 +288,67 @@ def _make_table(fields, table, strainer=None):
     return tmp
 
 
-def _make_data(data, fields, strainer=None):
+def _make_data(data, fields, strainer=None, preloaded=None):
     rr = list()
     for t in data:
-        rr.append(_make_table(fields, t, strainer))
+        rr.append(_make_table(fields, t, strainer, preloaded))
     return rr
 
 
-def _search(table, fields, search):
+def _like_escape(v):
+    return str(v).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _split_value(v):
+    return list(v) if isinstance(v, (list, tuple, set)) else str(v).split(',')
+
+
+def _range(column, v):
+    low, high = _split_value(v)
+    conditions = list()
+    if low not in (None, ''):
+        conditions.append(column.__ge__(low))
+    if high not in (None, ''):
+        conditions.append(column.__le__(high))
+    return and_(*conditions)
+
+
+def _contains(column, v):
+    # 配置在FULLTEXT_COLUMNS中的字段，在MySQL上使用FULLTEXT索引，需要先建立对应索引
+    if f"{column.table.name}.{column.name}" in FULLTEXT_COLUMNS and db.engine.dialect.name == 'mysql':
+        return column.match(v)
+    return column.contains(v)
+
+
+# 搜索操作符，eq、prefix、in、range可以利用普通索引，contains会编译为LIKE '%v%'
+SEARCH_OPERATORS = {
+    'eq': lambda column, v: column.__eq__(v),
+    'prefix': lambda column, v: column.like(f"{_like_escape(v)}%", escape='\\'),
+    'in': lambda column, v: column.in_(_split_value(v)),
+    'range': _range,
+    'contains': _contains,
+}
+
+
+def _search(table, fields, search, operators=None):
+    """
+    :param search: {字段: 值}，值也可以是{"op": 操作符, "value": 值}来指定本次查询的操作符
+    :param operators: {字段: 操作符}，字段的默认操作符，见SEARCH_OPERATORS；未指定时沿用原有规则，其余字段为contains
+    """
+    if operators is None:
+        operators = dict()
+    columns = getattr(table, '__table__').columns.keys()
     and_fields_list = list()
     for k, v in search.items():
-        if k in fields:
-            if k in ('delete_at', 'used_at') and v is None:
+        if k in fields or k in columns:
+            op = operators.get(k)
+            if isinstance(v, dict) and 'op' in v:
+                op, v = v['op'], v.get('value')
+            if op is not None:
+                if op not in SEARCH_OPERATORS:
+                    raise ValueError(f"search operator {op} is not supported")
+                and_fields_list.append(SEARCH_OPERATORS[op](getattr(table, k), v))
+            elif k in ('delete_at', 'used_at') and v is None:
                 and_fields_list.append(getattr(getattr(table, k), '__eq__')(v))
             elif k in ('manager_customer_id', 'owner_id') and v:
                 and_fields_list.append(getattr(getattr(table, k), '__eq__')(v))
@@ -165,7 +359,7 @@ def _search(table, fields, search):
             elif k == 'pay_at' and v == 'not None':
                 and_fields_list.append(getattr(getattr(table, k), '__ne__')(None))
             else:
-                and_fields_list.append(getattr(getattr(table, k), 'contains')(v))
+                and_fields_list.append(SEARCH_OPERATORS['contains'](getattr(table, k), v))
     return and_fields_list
 
 
@@ -185,7 +379,68 @@ def _advance_search(table, advance_search):
     return and_fields_list
 
 
-def get_table_data(table, args, appends=None, removes=None, advance_search=None, order_by=None):
+def _encode_cursor(row):
+    # create_at没有非空约束，为NULL时编码为null
+    create_at = row.create_at.isoformat() if row.create_at is not None else None
+    return base64.urlsafe_b64encode(json.dumps([create_at, row.id]).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        create_at, key_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return datetime.datetime.fromisoformat(create_at) if create_at is not None else None, key_id
+    except Exception:
+        raise ValueError(f"invalid cursor {cursor}")
+
+
+def _approximate_count(table, search_sql):
+    """
+    游标分页的总数，按查询语句缓存KEYSET_COUNT_EXPIRE秒，不保证精确
+    """
+    statement = search_sql.statement.compile()
+    digest = hashlib.md5(f"{statement}{sorted(statement.params.items(), key=str)}".encode()).hexdigest()
+    key = f"table_count::{table.__tablename__}::{digest}"
+    total = redis_db.get(key)
+    if total is None:
+        total = search_sql.count()
+        redis_db.set(key, total, ex=KEYSET_COUNT_EXPIRE)
+    return int(total)
+
+
+def _keyset_page(table, search_sql, fields, args):
+    """
+    按(create_at, id)倒序的游标分页，翻页代价与页码无关。
+    MySQL倒序时NULL排在最后，create_at为NULL的记录在所有有时间的记录之后按id倒序返回
+    :param args: cursor 上一页返回的next_cursor，为空表示第一页；with_total 为true时返回缓存的近似总数
+    """
+    size = args.get('size') or KEYSET_DEFAULT_SIZE
+    page_sql = search_sql
+    if args.get('cursor'):
+        try:
+            create_at, key_id = _decode_cursor(args.get('cursor'))
+        except ValueError as e:
+            logger.error(str(e))
+            return False
+        if create_at is None:
+            # 已翻到create_at为NULL的部分，只按id继续
+            page_sql = page_sql.filter(table.create_at.__eq__(None), table.id.__lt__(key_id))
+        else:
+            page_sql = page_sql.filter(or_(table.create_at.__lt__(create_at),
+                                           and_(table.create_at.__eq__(create_at), table.id.__lt__(key_id)),
+                                           table.create_at.__eq__(None)))
+    table_data = page_sql.order_by(table.create_at.desc(), table.id.desc()) \
+        .options(*_loader_options(table, fields)).limit(size + 1).all()
+    has_more = len(table_data) > size
+    table_data = table_data[:size]
+    result = {"records": _make_data(table_data, fields, preloaded=_preload(table, table_data, fields)),
+              "size": size,
+              "next_cursor": _encode_cursor(table_data[-1]) if has_more else None}
+    if args.get('with_total') == 'true':
+        result['total'] = _approximate_count(table, search_sql)
+    return result
+
+
+def get_table_data(table, args, appends=None, removes=None, advance_search=None, order_by=None, operators=None):
     if appends is None:
         appends = []
     if removes is None:
@@ -206,7 +461,7 @@ def get_table_data(table, args, appends=None, removes=None, advance_search=None,
 
     filter_args = list()
     if search:
-        filter_args.extend(_search(table, fields, search))
+        filter_args.extend(_search(table, fields, search, operators))
         if advance_search is not None:
             filter_args.extend(_advance_search(table, advance_search))
         search_sql = base_sql.filter(and_(*filter_args))
@@ -217,18 +472,22 @@ def get_table_data(table, args, appends=None, removes=None, advance_search=None,
         else:
             search_sql = base_sql
 
+    if page == 'cursor':
+        return _keyset_page(table, search_sql, fields, args)
+
     if order_by is not None:
         search_sql = search_sql.order_by(getattr(getattr(table, order_by), "desc")())
 
     page_len = search_sql.count()
+    data_sql = search_sql.options(*_loader_options(table, fields))
     if page != 'true':
-        table_data = search_sql.all()
+        table_data = data_sql.all()
     else:
         if page_len < (current - 1) * size:
             current = 1
-        table_data = search_sql.offset((current - 1) * size).limit(size).all()
+        table_data = data_sql.offset((current - 1) * size).limit(size).all()
 
-    r = _make_data(table_data, fields)
+    r = _make_data(table_data, fields, preloaded=_preload(table, table_data, fields))
 
     if table.__name__ == 'Elements':
         pop_list = list()
@@ -241,7 +500,8 @@ def get_table_data(table, args, appends=None, removes=None, advance_search=None,
     return {"records": r, "total": page_len, "size": size, "current": current} if page == 'true' else {"records": r}
 
 
-def get_table_data_by_id(table, key_id, appends=None, removes=None, strainer=None, search=None, advance_search=None):
+def get_table_data_by_id(table, key_id, appends=None, removes=None, strainer=None, search=None, advance_search=None,
+                         operators=None):
     if removes is None:
         removes = []
     if appends is None:
@@ -255,7 +515,7 @@ def get_table_data_by_id(table, key_id, appends=None, removes=None, strainer=Non
         filter_args.append(getattr(getattr(table, 'id'), '__eq__')(key_id))
         t = base_sql.filter(and_(*filter_args)).first()
     else:
-        filter_args = _search(table, fields, search)
+        filter_args = _search(table, fields, search, operators)
         filter_args.append(getattr(getattr(table, 'id'), '__eq__')(key_id))
         t = base_sql.filter(and_(*filter_args)).first()
     if t:
@@ -271,73 +531,187 @@ def create_member_card_num(prefix='777'):
 
 
 def upload_fdfs(file):
+    """
+    上传文件到FastDFS。请求体分块写入临时文件，同时计算sha256，不在内存中保留整个文件；
+    若ConfigFiles中已有相同内容的文件，直接复用其storage，不再上传
+    :param file: werkzeug FileStorage
+    :return: (storage, checksum)
+    """
     filename = file.filename
     extension = filename.split('.')[-1] if '.' in filename else ''
-    ret = fdfs_client.upload_by_buffer(file.read(), file_ext_name=extension)
+    sha256 = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(suffix=f".{extension}" if extension else "") as spool:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            spool.write(chunk)
+        spool.flush()
+        checksum = sha256.hexdigest()
+
+        existed = ConfigFiles.query.filter(ConfigFiles.checksum.__eq__(checksum),
+                                           ConfigFiles.delete_at.__eq__(None)).first()
+        if existed:
+            logger.info(f"{filename} is identical to {existed.storage}, skip uploading")
+            return existed.storage, checksum
+
+        # upload_by_filename从磁盘分块发送
+        ret = fdfs_client.upload_by_filename(spool.name)
     logger.info(ret)
-    return ret['Remote file_id'].decode()
+    return ret['Remote file_id'].decode(), checksum
 
 
-def run_job(job, order, params):
+def prepare_job(job, order, params):
     """
-    目前仅支持k8s运行job
-    :param order:
+    在当前线程中完成启动job前的数据库读取，返回的dict不再依赖ORM session，可交给线程池执行
     :param job:
-    :param params: parent的tag以及其产生的output合并的dict， 如果output的key和其tag冲突，则取output的值
-    :return:
+    :param order:
+    :param params: parent的tag以及其产生的output合并的dict
+    :return: dict
     """
-    try:
-        kube_job = KubeMgmt(job.run_env)
-        kube_job.cfg = load_yaml(job.id)
-        kube_job.cfg['metadata']['name'] = f"{order.name}-{order.run_times}"
-        # yaml_command 是个list
-        yaml_command = kube_job.cfg['spec']['template']['spec']['containers'][0]['command']
-        new_args = list()
-        new_command = list()
-        for arg in yaml_command:
-            if re.search(r'^<.*?>$', arg):
-                _, tag_belong, tag = re.findall(r'<(.*?)>', arg)[0].split(',')
-                if not tag_belong or tag_belong == job.name:
-                    # 如果tab_belong为空，或者名字等于当前执行job name，取自身tag
-                    for tag_ in job.tags:
-                        if tag_.arg_name.name == tag:
-                            new_x = re.sub('<.*?>', tag_.value, arg)
-                            new_args.append(new_x)
-                elif job.parent_id and tag_belong == job.parent.name:
-                    # 当前参数从父级job中获取，包括从父级tag以及output中取
-                    if tag in params.keys():
-                        new_x = re.sub('<.*?>', params.get(tag), arg)
-                        new_args.append(new_x)
-            else:
-                new_command.append(arg)
+    return {"run_env": job.run_env,
+            "storage": get_yaml_storage(job.id),
+            "job_name": job.name,
+            "parent_name": job.parent.name if job.parent_id else None,
+            "tags": {t.arg_name.name: t.value for t in job.tags},
+            "params": params,
+            "k8s_job_name": f"{order.name}-{order.run_times}",
+            "order_id": order.id}
+
+
+def render_job(prepared):
+    """
+    根据prepare_job的结果渲染job manifest，不访问数据库
+    :param prepared: prepare_job的返回
+    :return: dict
+    """
+    with RUN_JOB_SECONDS.labels('yaml_fetch').time():
+        cfg, command = fetch_template(prepared['storage'])
+    with RUN_JOB_SECONDS.labels('render').time():
+        cfg['metadata']['name'] = prepared['k8s_job_name']
+        cfg['spec']['template']['spec']['containers'][0]['command'] = command.render(
+            prepared['job_name'], prepared['parent_name'], prepared['tags'], prepared['params'])
+    return cfg
 
-        new_command.extend(new_args)
 
-        kube_job.cfg['spec']['template']['spec']['containers'][0]['command'] = new_command
+def _render_or_error(prepared):
+    try:
+        return render_job(prepared), None
+    except Exception as e:
+        traceback.print_exc()
+        return None, str(e)
+
 
+def launch_job(prepared):
+    """
+    渲染yaml并在k8s中创建job，不访问数据库
+    :param prepared: prepare_job的返回
+    :return:
+    """
+    try:
+        kube_job = KubeMgmt(prepared['run_env'])
+        kube_job.cfg = render_job(prepared)
         start_result = kube_job.start_job()
         if start_result.get('code') != 'success':
             raise Exception(start_result['message'])
-        order.run_times += 1
-        job_name = kube_job.cfg['metadata']['name']
         # kube_job.watch_job(job_name)
-        start_result['data']['child_order_id'] = order.id
+        start_result['data']['child_order_id'] = prepared['order_id']
         return start_result
     except Exception as e:
         traceback.print_exc()
         return false_return(message=str(e))
 
 
+def _mark_launched(order):
+    # 预先创建的订单和force重跑的订单都在job创建成功后才进入运行中
+    order_transition(order.status, ORDER_RUNNING)
+    order.status = ORDER_RUNNING
+    order.run_times += 1
+
+
+def run_job(job, order, params):
+    """
+    目前仅支持k8s运行job
+    :param order:
+    :param job:
+    :param params: parent的tag以及其产生的output合并的dict， 如果output的key和其tag冲突，则取output的值
+    :return:
+    """
+    try:
+        prepared = prepare_job(job, order, params)
+    except Exception as e:
+        traceback.print_exc()
+        return false_return(message=str(e))
+    start_result = launch_job(prepared)
+    if start_result.get('code') == 'success':
+        _mark_launched(order)
+    return start_result
+
+
+def run_jobs(job_orders, params, dry_run=False):
+    """
+    批量启动多个job：并发渲染yaml后，按master分组通过KubeMgmt.start_jobs并发提交
+    :param job_orders: [(job, order), ...]
+    :param params: 同run_job
+    :param dry_run: 为True时只在k8s服务端校验manifest，不创建job，也不修改订单
+    :return: 与job_orders顺序一致的run_job结果列表
+    """
+    run_results = [None] * len(job_orders)
+    prepared_list = list()
+    for index, (job, order) in enumerate(job_orders):
+        try:
+            prepared_list.append((index, prepare_job(job, order, params)))
+        except Exception as e:
+            traceback.print_exc()
+            run_results[index] = false_return(message=str(e))
+
+    if prepared_list:
+        masters = {prepared['run_env'] for _, prepared in prepared_list}
+        max_workers = min(len(prepared_list),
+                          sum(KubeMasterConcurrency.get(m, KUBE_DEFAULT_CONCURRENCY) for m in masters))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            rendered = list(executor.map(_render_or_error, [prepared for _, prepared in prepared_list]))
+
+        manifests_by_master = defaultdict(list)
+        for (index, prepared), (manifest, error) in zip(prepared_list, rendered):
+            if error is not None:
+                run_results[index] = false_return(message=error)
+            else:
+                manifests_by_master[prepared['run_env']].append((index, prepared, manifest))
+
+        def _submit(master):
+            items = manifests_by_master[master]
+            try:
+                return items, KubeMgmt(master).start_jobs([manifest for _, _, manifest in items], dry_run)
+            except Exception as e:
+                traceback.print_exc()
+                return items, [false_return(message=str(e)) for _ in items]
+
+        if manifests_by_master:
+            with ThreadPoolExecutor(max_workers=len(manifests_by_master)) as executor:
+                for items, results in executor.map(_submit, list(manifests_by_master.keys())):
+                    for (index, prepared, _), result in zip(items, results):
+                        if result.get('code') == 'success':
+                            result['data']['child_order_id'] = prepared['order_id']
+                        run_results[index] = result
+
+    if not dry_run:
+        for (job, order), result in zip(job_orders, run_results):
+            if result.get('code') == 'success':
+                _mark_launched(order)
+    return run_results
+
+
 def run_downstream(**kwargs):
     """
 
     :param kwargs: job_id 未当前任务的ID，即父级ID， 用来启动下游JOB
+                   parallel 是否并发启动下游job，默认DOWNSTREAM_PARALLEL
     :return:
     """
     try:
         job_id = kwargs['job_id']
         upstream_order_id = kwargs.get('upstream_order_id')
         force = kwargs.get('force')
+        parallel = kwargs.get('parallel', DOWNSTREAM_PARALLEL)
         job = Jobs.query.get(job_id)
 
         if not job:
@@ -346,32 +720,40 @@ def run_downstream(**kwargs):
         # 任务自身tag
         job_tags = {t.arg_name.name: t.value for t in job.tags}
         # 任务产生的output中的tag
-        command_params = kwargs.get('command_params')
+        command_params = kwargs.get('command_params') or dict()
 
         # 合并父级job的tag和其输出，如果输出和job tag冲突，那取输出中的tag
         for k, v in job_tags.items():
             if k not in command_params.keys():
                 command_params[k] = v
 
-        child_jobs = job.children
+        # 同级任务按seq先后启动
+        child_jobs = sorted(job.children, key=lambda j: j.seq or 0)
 
         if not child_jobs:
             return success_return(message='no children job')
 
-        run_results = []
+        job_orders = list()
         for child_job in child_jobs:
             if child_job.run_env in ('k8sm01', 'k8sm02'):
                 new_child_job_order = new_data_obj("Orders", **{"parent_id": upstream_order_id,
                                                                 "job_id": child_job.id})
 
-                if not new_child_job_order.get('new_one') and force == 0:
+                # 已存在但未启动过的订单（例如由执行计划预先创建的）可以直接使用
+                if not new_child_job_order.get('new_one') and new_child_job_order['obj'].run_times and force == 0:
                     raise Exception(
                         'The downstream jos has been done, you cannot run it again. If you wanna do so, please set force=1')
 
                 if not new_child_job_order['obj'].name:
                     new_child_job_order['obj'].name = f"{Orders.query.get(upstream_order_id).name}-{child_job.name}"
 
-                run_results.append(run_job(child_job, new_child_job_order.get('obj'), command_params))
+                job_orders.append((child_job, new_child_job_order.get('obj')))
+
+        DOWNSTREAM_FANOUT.observe(len(job_orders))
+        if parallel and len(job_orders) > 1:
+            run_results = run_jobs(job_orders, command_params)
+        else:
+            run_results = [run_job(child_job, child_order, command_params) for child_job, child_order in job_orders]
         failed_list = list()
         success_list = list()
         if run_results:
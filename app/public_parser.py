@@ -1,8 +1,118 @@
 import yaml
-from app import logger
-from app.models import Jobs, FDFS_URL
+from app import logger, redis_db
+from app.models import Jobs, ConfigFiles, FDFS_URL, YAML_CACHE_SIZE, YAML_CACHE_REDIS, REDIS_24H
 from app.common import false_return
+from app.command_template import compile_command, container_command
+from collections import OrderedDict
 import urllib.request
+import threading
+import copy
+
+
+class YamlTemplateCache:
+    """
+    已解析yaml模板的缓存，以FastDFS file id为key，文件内容不变则id不变。
+    一级为进程内LRU，二级为可选的Redis（存放原始yaml文本，多个worker共享）。
+    get返回深拷贝，调用方可以随意修改；command的编译结果与yaml一起缓存
+    """
+
+    def __init__(self, max_size=YAML_CACHE_SIZE, redis_client=None, redis_expire=REDIS_24H):
+        self.max_size = max_size
+        self.redis_client = redis_client
+        self.redis_expire = redis_expire
+        # file id -> [cfg, CompiledCommand]
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _redis_key(file_path):
+        return f"yaml_template::{file_path}"
+
+    def _download(self, file_path):
+        text = None
+        if self.redis_client is not None:
+            try:
+                text = self.redis_client.get(self._redis_key(file_path))
+            except Exception as e:
+                logger.error(f"get yaml {file_path} from redis failed, {e}")
+        if text is None:
+            text = urllib.request.urlopen(f"{FDFS_URL}{file_path}").read().decode()
+            if self.redis_client is not None:
+                try:
+                    self.redis_client.set(self._redis_key(file_path), text, ex=self.redis_expire)
+                except Exception as e:
+                    logger.error(f"set yaml {file_path} to redis failed, {e}")
+        return text
+
+    def _entry(self, file_path):
+        with self._lock:
+            entry = self._cache.get(file_path)
+            if entry is not None:
+                self._cache.move_to_end(file_path)
+                return entry
+        entry = [yaml.safe_load(self._download(file_path)), None]
+        with self._lock:
+            self._cache[file_path] = entry
+            self._cache.move_to_end(file_path)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return entry
+
+    def get(self, file_path):
+        return copy.deepcopy(self._entry(file_path)[0])
+
+    def get_template(self, file_path):
+        """
+        :return: (yaml的深拷贝, CompiledCommand)
+        :raise TemplateError: command格式错误
+        """
+        entry = self._entry(file_path)
+        if entry[1] is None:
+            entry[1] = compile_command(container_command(entry[0]))
+        return copy.deepcopy(entry[0]), entry[1]
+
+    def invalidate(self, file_path):
+        with self._lock:
+            self._cache.pop(file_path, None)
+        if self.redis_client is not None:
+            try:
+                self.redis_client.delete(self._redis_key(file_path))
+            except Exception as e:
+                logger.error(f"delete yaml {file_path} from redis failed, {e}")
+
+
+yaml_cache = YamlTemplateCache(redis_client=redis_db if YAML_CACHE_REDIS else None)
+
+
+def get_yaml_storage(job_id):
+    """
+    获取job当前生效的配置文件在FastDFS中的存储路径
+    :param job_id:
+    :return: ConfigFiles.storage
+    """
+    config_file = ConfigFiles.query.filter(ConfigFiles.job_id.__eq__(job_id),
+                                           ConfigFiles.status.__eq__(1),
+                                           ConfigFiles.delete_at.__eq__(None)).first()
+    if not config_file:
+        raise Exception(f"job {job_id} does not have an active config file")
+    return config_file.storage
+
+
+def fetch_yaml(file_path):
+    """
+    从FastDFS下载并解析yaml（经过yaml_cache），不访问数据库，可以在线程池中调用
+    :param file_path: ConfigFiles.storage
+    :return: dict, 缓存的深拷贝
+    """
+    return yaml_cache.get(file_path)
+
+
+def fetch_template(file_path):
+    """
+    同fetch_yaml，同时返回已编译的command
+    :return: (dict, CompiledCommand)
+    """
+    return yaml_cache.get_template(file_path)
 
 
 def load_yaml(job_id):
@@ -10,8 +120,8 @@ def load_yaml(job_id):
         job = Jobs.query.get(job_id)
         if not job:
             raise Exception(f"job {job_id} does not exist")
-        file_path = job.config_files.query.filter_by(status=1).first().storage
-        cfg = yaml.safe_load(urllib.request.urlopen(f"{FDFS_URL}{file_path}"))
-        logger.debug(f"yaml config: {cfg}")
+        cfg = fetch_yaml(get_yaml_storage(job.id))
+        logger.debug(f"yaml config of job {job_id} loaded")
+        return cfg
     except Exception as e:
         return false_return(message=str(e))
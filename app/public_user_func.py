@@ -44,7 +44,7 @@ def create_user(table_obj, **kwargs):
 def register(table_obj, **kwargs):
     key = f'back::verification_code::{kwargs["phone"]}'
     try:
-        if redis_db.exists(key) and redis_db.get(key) == kwargs['verify_code']:
+        if redis_db.check_value(key, kwargs['verify_code']):
             return create_user(table_obj, **kwargs)
         else:
             return false_return(message='验证码错误'), 400
@@ -1,21 +1,98 @@
 import urllib.request
 from kubernetes import client, config
 from kubernetes.watch import Watch
+from kubernetes.client.rest import ApiException
+from concurrent.futures import ThreadPoolExecutor
 from app.public_parser import load_yaml
-from app.models import KubeMaster, Jobs, FDFS_URL
+from app.models import KubeMaster, Jobs, FDFS_URL, KubeMasterConcurrency, KUBE_DEFAULT_CONCURRENCY, \
+    KUBE_CREATE_RETRIES, KUBE_RETRY_BASE_DELAY, KUBE_RETRY_MAX_DELAY
 from app import logger
 from app.common import false_return, success_return
+from app.metrics import RUN_JOB_SECONDS, KUBE_JOB_CREATE
 import yaml
 import time
+import os
+import random
+import json
+import threading
+
+
+class InstrumentedApiClient(client.ApiClient):
+    """
+    每次HTTP请求结束后回调listeners(method, elapsed)，供请求级统计使用
+    """
+
+    def __init__(self, *args, listeners=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.listeners = listeners if listeners is not None else list()
+
+    def request(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().request(method, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            for listener in self.listeners:
+                listener(method, elapsed)
+
+
+class KubeClientRegistry:
+    """
+    进程内共享的k8s ApiClient，每个master一个，复用其连接池（keep-alive）。
+    只有kubeconfig文件的mtime变化时才会重新加载，线程安全
+    """
+
+    def __init__(self):
+        # master -> (kubeconfig mtime, ApiClient)
+        self._clients = dict()
+        # master -> 创建job的并发信号量，进程内所有请求共享
+        self._semaphores = dict()
+        self._lock = threading.Lock()
+        # 所有ApiClient共享的请求回调，见InstrumentedApiClient
+        self.listeners = list()
+
+    def semaphore(self, master):
+        with self._lock:
+            if master not in self._semaphores:
+                self._semaphores[master] = threading.BoundedSemaphore(
+                    KubeMasterConcurrency.get(master, KUBE_DEFAULT_CONCURRENCY))
+            return self._semaphores[master]
+
+    def get(self, master):
+        config_file = KubeMaster.get(master)
+        if config_file is None:
+            raise Exception(f"k8s master {master} does not exist")
+        mtime = os.path.getmtime(config_file)
+        with self._lock:
+            cached = self._clients.get(master)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            logger.info(f"load kube config of {master} from {config_file}")
+            configuration = client.Configuration()
+            config.load_kube_config(config_file=config_file, client_configuration=configuration)
+            configuration.connection_pool_maxsize = KubeMasterConcurrency.get(master, KUBE_DEFAULT_CONCURRENCY)
+            # 旧的ApiClient可能仍有请求在使用，不主动关闭，交给GC回收
+            api_client = InstrumentedApiClient(configuration=configuration, listeners=self.listeners)
+            self._clients[master] = (mtime, api_client)
+            return api_client
+
+    def clear(self, master=None):
+        with self._lock:
+            if master is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(master, None)
+
+
+kube_clients = KubeClientRegistry()
 
 
 class KubeMgmt:
     def __init__(self, master, namespace='default'):
-        # Configs can be set in Configuration class directly or using helper utility
-        logger.debug(KubeMaster.get(master))
-        config.load_kube_config(config_file=KubeMaster.get(master))
-        self.v1 = client.CoreV1Api()
-        self.batch = client.BatchV1Api()
+        api_client = kube_clients.get(master)
+        self.master = master
+        self.v1 = client.CoreV1Api(api_client)
+        self.batch = client.BatchV1Api(api_client)
         self.namespace = namespace
         self.watcher = Watch()
         self.cfg = None
@@ -27,17 +104,83 @@ class KubeMgmt:
         for i in ret.items:
             print("%s\t%s\t%s" % (i.status.pod_ip, i.metadata.namespace, i.metadata.name))
 
-    def start_job(self, job_id=None):
+    @staticmethod
+    def _retry_delay(attempt, error):
+        retry_after = (error.headers or {}).get('Retry-After') if error.status == 429 else None
+        if retry_after and str(retry_after).isdigit():
+            return min(int(retry_after), KUBE_RETRY_MAX_DELAY)
+        return min(KUBE_RETRY_BASE_DELAY * 2 ** attempt, KUBE_RETRY_MAX_DELAY) * random.uniform(0.5, 1.5)
+
+    def create_job(self, body, dry_run=False):
+        """
+        创建单个job，409/429/5xx按指数退避加随机抖动重试，同一master的并发受KubeMasterConcurrency限制
+        :param body: 渲染后的job manifest
+        :param dry_run: 为True时使用服务端dryRun=All，只校验不创建
+        :return:
+        """
+        with RUN_JOB_SECONDS.labels('k8s_create').time():
+            result = self._create_job(body, dry_run)
+        if not dry_run:
+            KUBE_JOB_CREATE.labels(self.master, 'success' if result.get('code') == 'success' else 'failure').inc()
+        return result
+
+    @staticmethod
+    def _status_reason(error):
+        """
+        ApiException.reason是HTTP的reason phrase(例如Conflict)，k8s Status中的reason(例如AlreadyExists)在body里
+        """
         try:
-            if job_id is not None:
-                self.cfg = load_yaml(job_id)
-
-            job = self.batch.create_namespaced_job(namespace=self.namespace, body=self.cfg)
-            assert isinstance(job, client.V1Job)
-            return success_return(message='k8s job create success', data={'job_name': self.cfg['metadata']['name']})
-        except Exception as e:
-            logger.error(str(e))
-            return false_return(message=str(e))
+            return json.loads(error.body).get('reason')
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+    def _create_job(self, body, dry_run):
+        kwargs = {"namespace": self.namespace, "body": body}
+        if dry_run:
+            kwargs['dry_run'] = 'All'
+        job_name = None
+        for attempt in range(KUBE_CREATE_RETRIES + 1):
+            try:
+                job_name = body['metadata']['name']
+                with kube_clients.semaphore(self.master):
+                    job = self.batch.create_namespaced_job(**kwargs)
+                assert isinstance(job, client.V1Job)
+                return success_return(message='k8s job create success', data={'job_name': job_name})
+            except ApiException as e:
+                already_exists = e.status == 409 and self._status_reason(e) == 'AlreadyExists'
+                if already_exists and attempt:
+                    # 上一次请求已经创建成功，只是响应丢失
+                    return success_return(message='k8s job create success', data={'job_name': job_name})
+                retryable = (e.status == 409 and not already_exists) or e.status == 429 or \
+                            (e.status or 0) >= 500
+                if not retryable or attempt == KUBE_CREATE_RETRIES:
+                    logger.error(f"create job {job_name} failed, {e}")
+                    return false_return(message=str(e))
+                time.sleep(self._retry_delay(attempt, e))
+            except Exception as e:
+                logger.error(f"create job {job_name} failed, {e}")
+                return false_return(message=str(e))
+
+    def start_job(self, job_id=None):
+        if job_id is not None:
+            self.cfg = load_yaml(job_id)
+            # load_yaml失败时返回false_return
+            if self.cfg.get('code') == 'false':
+                return self.cfg
+        return self.create_job(self.cfg)
+
+    def start_jobs(self, manifests, dry_run=False):
+        """
+        通过同一个ApiClient连接池并发提交多个job
+        :param manifests: 渲染后的job manifest列表
+        :param dry_run: 为True时使用服务端dryRun=All批量校验
+        :return: 与manifests顺序一致的结果列表
+        """
+        if not manifests:
+            return []
+        max_workers = min(len(manifests), KubeMasterConcurrency.get(self.master, KUBE_DEFAULT_CONCURRENCY))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda manifest: self.create_job(manifest, dry_run), manifests))
 
     def watch_job(self, job_name, namespace=None):
         if namespace is None:
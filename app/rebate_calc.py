@@ -1,20 +1,133 @@
-from app.models import ItemsOrders, ShopOrders, Customers, BusinessUnits, BusinessUnitEmployees, CustomerRoles, \
-    ItemVerification, CloudWineRebates, make_uuid, FranchiseeOperators
+from app.models import get_model, make_uuid, REBATE_RATE_CHECK_INTERVAL
+from sqlalchemy import case, event
+from sqlalchemy.orm import selectinload, Session, object_session
+from collections import defaultdict
 from decimal import Decimal
 from app.common import submit_return, false_return, success_return
 from app.public_method import new_data_obj
-from app import db
+from app import db, redis_db, logger
+from app.role_registry import customer_role_id
+import threading
+import time
+
+
+class _Models:
+    """
+    返佣相关的model(Customers、CloudWineRebates等)不在本仓库的models中，
+    在调用时才通过get_model查找，模块可以正常导入，调用时抛出model X does not exist
+    """
+
+    def __getattr__(self, name):
+        return get_model(name)
+
+
+_models = _Models()
+
+REBATE_ROLES = ("FRANCHISEE_MANAGER", "BU_MANAGER", "BU_OPERATOR", "BU_WAITER")
+
+
+class RebateRateIndex:
+    """
+    返佣比例的内存索引，(sku_id, level, scene) -> {role_name: rate}，同一组合下多条规则的比例相加。
+    一次查询加载全部有效规则。返佣规则或角色通过ORM增删改并提交后自动调用bump_version，
+    各进程最多在check_interval秒后发现Redis中的版本号变化并重新加载；
+    query.update()/delete()等批量操作不触发ORM事件，需要手动调用bump_version
+    """
+
+    VERSION_KEY = "rebate_rates::version"
+
+    def __init__(self, check_interval=REBATE_RATE_CHECK_INTERVAL, watched=("CloudWineRebates", "CustomerRoles")):
+        """
+        :param check_interval: 检查Redis版本号的间隔秒数
+        :param watched: 增删改后需要重新加载索引的模型名，不存在的模型跳过
+        """
+        self.check_interval = check_interval
+        self._rates = None
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        for table in watched:
+            try:
+                model = get_model(table)
+            except Exception as e:
+                logger.info(f"rebate rate index does not watch {table}, {e}")
+                continue
+            for mutation in ('after_insert', 'after_update', 'after_delete'):
+                event.listen(model, mutation, self._mark_changed)
+
+    def _mark_changed(self, mapper, connection, target):
+        # 只记录在session上，提交成功后再更新版本号，回滚时丢弃
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('changed_rebate_indexes', set()).add(self)
+
+    def load(self):
+        roles, rebates = _models.CustomerRoles, _models.CloudWineRebates
+        rows = db.session.query(roles.name, rebates.sku_id, rebates.consumer_level, rebates.scene,
+                                rebates.rebate).join(roles, roles.id.__eq__(rebates.role_id)).filter(
+            rebates.status.__eq__(1), rebates.delete_at.__eq__(None)).all()
+        rates = dict()
+        for role_name, sku_id, level, scene, rebate in rows:
+            role_rates = rates.setdefault((sku_id, level, scene), dict())
+            role_rates[role_name] = role_rates.get(role_name, Decimal("0.00")) + rebate
+        logger.info(f"rebate rate index loaded, {len(rows)} rules")
+        return rates
+
+    def bump_version(self):
+        """
+        返佣规则增删改提交后调用，当前进程立即重新检查版本号
+        """
+        self._checked_at = 0
+        return redis_db.incr(self.VERSION_KEY)
+
+    def _current(self):
+        now = time.time()
+        if self._rates is not None and now - self._checked_at < self.check_interval:
+            return self._rates
+        with self._lock:
+            if self._rates is not None and now - self._checked_at < self.check_interval:
+                return self._rates
+            version = redis_db.get(self.VERSION_KEY)
+            if self._rates is None or version != self._version:
+                self._rates = self.load()
+                self._version = version
+            self._checked_at = now
+            return self._rates
+
+    def rates(self, sku_id, level, scene):
+        """
+        :return: {role_name: rate}，包含REBATE_ROLES中的全部角色，未配置的为0
+        """
+        role_rates = self._current().get((sku_id, level, scene), dict())
+        return {role: role_rates.get(role, Decimal("0.00")) for role in REBATE_ROLES}
+
+    def rebates(self, sku_id, level, scene, amount):
+        """
+        :return: {role_name: 返佣金额}
+        """
+        amount = Decimal(str(amount))
+        return {role: rate * amount for role, rate in self.rates(sku_id, level, scene).items()}
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_rebate_changes(session):
+    for index in session.info.pop('changed_rebate_indexes', set()):
+        try:
+            index.bump_version()
+        except Exception as e:
+            logger.error(f"bump rebate rate version failed, {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rebate_changes(session):
+    session.info.pop('changed_rebate_indexes', None)
+
+
+rebate_rates = RebateRateIndex()
 
 
 def get_rebate(role_name, sku_id, level, scene, amount):
-    role_id = CustomerRoles.query.filter_by(name=role_name).first().id
-    rebates = CloudWineRebates.query.filter(CloudWineRebates.role_id.__eq__(role_id),
-                                            CloudWineRebates.sku_id.__eq__(sku_id),
-                                            CloudWineRebates.consumer_level.__eq__(level),
-                                            CloudWineRebates.scene.__eq__(scene),
-                                            CloudWineRebates.status.__eq__(1),
-                                            CloudWineRebates.delete_at.__eq__(None)).all()
-    return Decimal("0.00") if rebates is None else sum(v.rebate for v in rebates) * Decimal(str(amount))
+    return rebate_rates.rebates(sku_id, level, scene, amount).get(role_name, Decimal("0.00"))
 
 
 def bu_rebate(employee, waiter_rebate, operator_rebate, manager_rebate):
@@ -35,28 +148,28 @@ def purchase_rebate(consumer_id, item_verification_id):
     :param item_verification_id:
     :return:
     """
-    consumer_obj = Customers.query.get(consumer_id)
+    consumer_obj = _models.Customers.query.get(consumer_id)
     bu_obj = consumer_obj.business_unit_employee.business_unit
     franchisee_obj = bu_obj.franchisee
     franchisee_manager = franchisee_obj.operators.filter(
-        FranchiseeOperators.job_desc.__eq__(
-            CustomerRoles.query.filter_by(name='FRANCHISEE_MANAGER').first().id)).first()
-    item_verification_obj = ItemVerification.query.get(item_verification_id)
+        _models.FranchiseeOperators.job_desc.__eq__(
+            customer_role_id('FRANCHISEE_MANAGER'))).first()
+    item_verification_obj = _models.ItemVerification.query.get(item_verification_id)
     item_order_id = item_verification_obj.item_order_id
-    item_obj = ItemsOrders.query.get(item_order_id)
+    item_obj = _models.ItemsOrders.query.get(item_order_id)
     shop_order_obj = item_obj.shop_orders
-    sku_id = ItemsOrders.query.get(item_order_id).item_id
+    sku_id = item_obj.item_id
     if consumer_obj.first_order_table == shop_order_obj.__class__.__name__ and consumer_obj.first_order_id == shop_order_obj.id:
         # 表明当前item order 属于首单，调用 purchase_rebate来计算购买返佣
         scene = "FIRST_PURCHASE"
     else:
         scene = "PURCHASE"
 
-    kwargs = {"sku_id": sku_id, "level": consumer_obj.level, "scene": scene}
-    f_manager_rebate = get_rebate("FRANCHISEE_MANAGER", **kwargs)
-    bu_manager_rebate = get_rebate("BU_MANAGER", **kwargs)
-    bu_operator_rebate = get_rebate("BU_OPERATOR", **kwargs)
-    bu_waiter_rebate = get_rebate("BU_WAITER", **kwargs)
+    rebates = rebate_rates.rebates(sku_id, consumer_obj.level, scene, item_verification_obj.verification_quantity)
+    f_manager_rebate = rebates["FRANCHISEE_MANAGER"]
+    bu_manager_rebate = rebates["BU_MANAGER"]
+    bu_operator_rebate = rebates["BU_OPERATOR"]
+    bu_waiter_rebate = rebates["BU_WAITER"]
 
     # 购买返回，返给加盟商老板
     franchisee_manager.employee_wechat.purse += f_manager_rebate
@@ -65,19 +178,19 @@ def purchase_rebate(consumer_id, item_verification_id):
                                                       "rebate_customer_id": franchisee_manager.employee_wechat.id,
                                                       "rebate_money": f_manager_rebate})
 
-    bu_employees = consumer_obj.business_unit.employees
+    bu_employees = bu_obj.employees
 
-    operator_role_id = CustomerRoles.query.filter_by(name="BU_OPERATOR").first().id
-    employee_operator = bu_employees.filter(BusinessUnitEmployees.job_desc.__eq__(operator_role_id)).first()
-    manger_role_id = CustomerRoles.query.filter_by(name="BU_MANAGER").first().id
-    employee_manager = bu_employees.filter(BusinessUnitEmployees.job_desc.__eq__(manger_role_id)).first()
+    operator_role_id = customer_role_id("BU_OPERATOR")
+    employee_operator = bu_employees.filter(_models.BusinessUnitEmployees.job_desc.__eq__(operator_role_id)).first()
+    manger_role_id = customer_role_id("BU_MANAGER")
+    employee_manager = bu_employees.filter(_models.BusinessUnitEmployees.job_desc.__eq__(manger_role_id)).first()
 
     # 店铺卖酒返佣。老板有躺赚，服务员和店长只有在首单销售中会产生返佣
     consumer_obj.business_unit_employee.employee_wechat.purse += bu_waiter_rebate
     if bu_waiter_rebate > 0:
         new_data_obj("CloudWinePersonalRebateRecords", **{"id": make_uuid(),
                                                           "item_verification_id": item_verification_id,
-                                                          "rebate_customer_id": bu_employees.employee_wechat.id,
+                                                          "rebate_customer_id": consumer_obj.business_unit_employee.employee_wechat.id,
                                                           "rebate_money": bu_waiter_rebate})
     if employee_operator and employee_operator.employee_wechat:
         employee_operator.employee_wechat.purse += bu_operator_rebate
@@ -116,39 +229,39 @@ def pickup_rebate(item_verification_id, pickup_employee_id, consumer_id):
     """
     # first order rebate
     try:
-        item_verification_obj = db.session.query(ItemVerification).with_for_update().filter(
-            ItemVerification.id.__eq__(item_verification_id)).first()
+        item_verification_obj = db.session.query(_models.ItemVerification).with_for_update().filter(
+            _models.ItemVerification.id.__eq__(item_verification_id)).first()
         if item_verification_obj.rebate_status != 0:
             return false_return(message='此订单已经返佣'), 400
 
         item_order_id = item_verification_obj.item_order_id
 
-        item_obj = ItemsOrders.query.get(item_order_id)
+        item_obj = _models.ItemsOrders.query.get(item_order_id)
 
-        consumer_obj = Customers.query.get(consumer_id)
-        pickup_employee = BusinessUnitEmployees.query.get(pickup_employee_id)
+        consumer_obj = _models.Customers.query.get(consumer_id)
+        pickup_employee = _models.BusinessUnitEmployees.query.get(pickup_employee_id)
         bu_obj = pickup_employee.business_unit
         franchisee_obj = bu_obj.franchisee
         franchisee_manager = franchisee_obj.operators.filter(
-            FranchiseeOperators.job_desc.__eq__(
-                CustomerRoles.query.filter_by(name='FRANCHISEE_MANAGER').first().id)).first()
+            _models.FranchiseeOperators.job_desc.__eq__(
+                customer_role_id('FRANCHISEE_MANAGER'))).first()
 
         # 卖酒返佣，包括躺赚
         # purchase_rebate(consumer_id, item_verification_id)
 
         bu_employees = pickup_employee.business_unit.employees
-        operator_role_id = CustomerRoles.query.filter_by(name="BU_OPERATOR").first().id
-        employee_operator = bu_employees.filter(BusinessUnitEmployees.job_desc.__eq__(operator_role_id)).first()
-        manger_role_id = CustomerRoles.query.filter_by(name="BU_MANAGER").first().id
-        employee_manager = bu_employees.filter(BusinessUnitEmployees.job_desc.__eq__(manger_role_id)).first()
+        operator_role_id = customer_role_id("BU_OPERATOR")
+        employee_operator = bu_employees.filter(_models.BusinessUnitEmployees.job_desc.__eq__(operator_role_id)).first()
+        manger_role_id = customer_role_id("BU_MANAGER")
+        employee_manager = bu_employees.filter(_models.BusinessUnitEmployees.job_desc.__eq__(manger_role_id)).first()
 
         # 获取rebate
-        kwargs = {"sku_id": item_obj.item_id, "level": consumer_obj.level, "scene": "PICKUP",
-                  "amount": item_verification_obj.verification_quantity}
-        f_manager_rebate = get_rebate("FRANCHISEE_MANAGER", **kwargs)
-        waiter_rebate = get_rebate("BU_WAITER", **kwargs)
-        operator_rebate = get_rebate("BU_OPERATOR", **kwargs)
-        manager_rebate = get_rebate("BU_MANAGER", **kwargs)
+        rebates = rebate_rates.rebates(item_obj.item_id, consumer_obj.level, "PICKUP",
+                                       item_verification_obj.verification_quantity)
+        f_manager_rebate = rebates["FRANCHISEE_MANAGER"]
+        waiter_rebate = rebates["BU_WAITER"]
+        operator_rebate = rebates["BU_OPERATOR"]
+        manager_rebate = rebates["BU_MANAGER"]
 
         # 取酒的时候，加盟商躺赚返佣计算
         franchisee_manager.employee_wechat.purse += f_manager_rebate
@@ -192,3 +305,188 @@ def pickup_rebate(item_verification_id, pickup_employee_id, consumer_id):
         return submit_return("返佣成功", "返佣失败")
     except Exception as e:
         return false_return(message=str(e)), 400
+
+
+def _lock_verifications(verification_ids):
+    """
+    按主键顺序一次锁定全部核销记录，并发的批量结算以相同顺序加锁，避免死锁
+    """
+    return {v.id: v for v in db.session.query(_models.ItemVerification).with_for_update().filter(
+        _models.ItemVerification.id.in_(sorted(set(verification_ids)))).order_by(_models.ItemVerification.id).all()}
+
+
+def _rebate_role_ids():
+    return {name: customer_role_id(name) for name in REBATE_ROLES}
+
+
+def _load_org(bu_ids, role_ids):
+    """
+    一次性加载店铺、店长/店主、加盟商老板
+    :return: (bu_id -> franchisee_id, (bu_id, job_desc) -> employee customer_id, franchisee_id -> manager customer_id)
+    """
+    bu_franchisee = {bu.id: bu.franchisee_id for bu in _models.BusinessUnits.query.filter(
+        _models.BusinessUnits.id.in_(bu_ids)).all()}
+
+    bu_staff = dict()
+    for employee in _models.BusinessUnitEmployees.query.filter(
+            _models.BusinessUnitEmployees.business_unit_id.in_(bu_ids),
+            _models.BusinessUnitEmployees.job_desc.in_([role_ids["BU_OPERATOR"], role_ids["BU_MANAGER"]])).order_by(
+            _models.BusinessUnitEmployees.id).all():
+        bu_staff.setdefault((employee.business_unit_id, employee.job_desc), employee.customer_id)
+
+    franchisee_managers = dict()
+    for operator in _models.FranchiseeOperators.query.filter(
+            _models.FranchiseeOperators.franchisee_id.in_(set(bu_franchisee.values())),
+            _models.FranchiseeOperators.job_desc.__eq__(role_ids["FRANCHISEE_MANAGER"])).order_by(
+            _models.FranchiseeOperators.id).all():
+        franchisee_managers.setdefault(operator.franchisee_id, operator.customer_id)
+    return bu_franchisee, bu_staff, franchisee_managers
+
+
+def _split_rebates(rebates, waiter_id, bu_id, org, role_ids):
+    """
+    按单笔结算的规则分配一笔核销的返佣，店主不存在时其份额归店长
+    :return: [(customer_id, money, 是否在金额为0时也记账)]
+    """
+    bu_franchisee, bu_staff, franchisee_managers = org
+    operator_id = bu_staff.get((bu_id, role_ids["BU_OPERATOR"]))
+    manager_id = bu_staff.get((bu_id, role_ids["BU_MANAGER"]))
+    f_manager_id = franchisee_managers.get(bu_franchisee.get(bu_id))
+    if f_manager_id is None:
+        raise Exception(f"franchisee manager of business unit {bu_id} does not exist")
+
+    entries = [(f_manager_id, rebates["FRANCHISEE_MANAGER"], True),
+               (waiter_id, rebates["BU_WAITER"], False)]
+    if operator_id:
+        entries.append((operator_id, rebates["BU_OPERATOR"], False))
+    elif manager_id:
+        entries.append((manager_id, rebates["BU_OPERATOR"], False))
+    if manager_id:
+        entries.append((manager_id, rebates["BU_MANAGER"], False))
+    return entries
+
+
+def _apply_settlement(ledger):
+    """
+    :param ledger: [(item_verification_id, customer_id, money)]
+    """
+    purse_delta = defaultdict(Decimal)
+    for _, customer_id, money in ledger:
+        purse_delta[customer_id] += money
+    purse_delta = {k: v for k, v in purse_delta.items() if v}
+    if purse_delta:
+        # 一条UPDATE，按CASE给每个客户加上汇总后的金额，不依赖ORM对象中可能过期的purse
+        db.session.query(_models.Customers).filter(_models.Customers.id.in_(sorted(purse_delta.keys()))).update(
+            {_models.Customers.purse: _models.Customers.purse + case(purse_delta, value=_models.Customers.id, else_=0)},
+            synchronize_session=False)
+    if ledger:
+        db.session.execute(_models.CloudWinePersonalRebateRecords.__table__.insert().values(
+            [{"id": make_uuid(), "item_verification_id": verification_id, "rebate_customer_id": customer_id,
+              "rebate_money": money} for verification_id, customer_id, money in ledger]))
+
+
+def batch_pickup_rebate(settlements):
+    """
+    批量结算取酒返佣，结果与逐笔调用pickup_rebate一致
+    :param settlements: [{"item_verification_id": , "pickup_employee_id": , "consumer_id": }]
+    :return: data中settled为已结算的核销id，skipped为{核销id: 原因}
+    """
+    try:
+        locked = _lock_verifications(s['item_verification_id'] for s in settlements)
+        role_ids = _rebate_role_ids()
+        skipped = dict()
+        pending = list()
+        for s in settlements:
+            verification = locked.get(s['item_verification_id'])
+            if verification is None:
+                skipped[s['item_verification_id']] = '核销记录不存在'
+            elif verification.rebate_status != 0:
+                skipped[verification.id] = '此订单已经返佣'
+            else:
+                pending.append((verification, s))
+                # 同一批次内重复的核销id只结算一次
+                verification.rebate_status += 1
+
+        items = {i.id: i for i in _models.ItemsOrders.query.filter(
+            _models.ItemsOrders.id.in_({v.item_order_id for v, _ in pending})).all()}
+        consumers = {c.id: c for c in _models.Customers.query.filter(
+            _models.Customers.id.in_({s['consumer_id'] for _, s in pending})).all()}
+        employees = {e.id: e for e in _models.BusinessUnitEmployees.query.filter(
+            _models.BusinessUnitEmployees.id.in_({s['pickup_employee_id'] for _, s in pending})).all()}
+        org = _load_org({e.business_unit_id for e in employees.values()}, role_ids)
+
+        ledger = list()
+        for verification, s in pending:
+            employee = employees[s['pickup_employee_id']]
+            rebates = rebate_rates.rebates(items[verification.item_order_id].item_id,
+                                           consumers[s['consumer_id']].level, "PICKUP",
+                                           verification.verification_quantity)
+            for customer_id, money, always in _split_rebates(rebates, employee.customer_id,
+                                                             employee.business_unit_id, org, role_ids):
+                if customer_id and (always or money > 0):
+                    ledger.append((verification.id, customer_id, money))
+
+        _apply_settlement(ledger)
+        return submit_return("返佣成功", "返佣失败",
+                             data={"settled": [v.id for v, _ in pending], "skipped": skipped})
+    except Exception as e:
+        db.session.rollback()
+        return false_return(message=str(e)), 400
+
+
+def batch_purchase_rebate(pairs):
+    """
+    批量结算购买返佣，结果与逐笔调用purchase_rebate一致，已结算过购买返佣的核销记录跳过
+    :param pairs: [(item_verification_id, consumer_id)]
+    :return: data中settled为已结算的核销id，skipped为{核销id: 原因}
+    """
+    try:
+        locked = _lock_verifications(verification_id for verification_id, _ in pairs)
+        role_ids = _rebate_role_ids()
+        skipped = dict()
+        pending = list()
+        for verification_id, consumer_id in pairs:
+            verification = locked.get(verification_id)
+            if verification is None:
+                skipped[verification_id] = '核销记录不存在'
+            elif verification.rebate_status & 2:
+                skipped[verification_id] = '此订单已经返佣'
+            else:
+                pending.append((verification, consumer_id))
+                verification.rebate_status += 2
+
+        items = {i.id: i for i in _models.ItemsOrders.query.options(
+            selectinload(_models.ItemsOrders.shop_orders)).filter(
+            _models.ItemsOrders.id.in_({v.item_order_id for v, _ in pending})).all()}
+        # 与purchase_rebate相同，通过顾客绑定的店员确定店铺，该店员即服务员
+        consumers = {c.id: c for c in _models.Customers.query.options(
+            selectinload(_models.Customers.business_unit_employee)).filter(
+            _models.Customers.id.in_({consumer_id for _, consumer_id in pending})).all()}
+        for consumer_id in {consumer_id for _, consumer_id in pending}:
+            if consumer_id not in consumers or consumers[consumer_id].business_unit_employee is None:
+                raise Exception(f"business unit employee of consumer {consumer_id} does not exist")
+        org = _load_org({c.business_unit_employee.business_unit_id for c in consumers.values()}, role_ids)
+
+        ledger = list()
+        for verification, consumer_id in pending:
+            consumer = consumers[consumer_id]
+            item = items[verification.item_order_id]
+            shop_order = item.shop_orders
+            if consumer.first_order_table == shop_order.__class__.__name__ and \
+                    consumer.first_order_id == shop_order.id:
+                scene = "FIRST_PURCHASE"
+            else:
+                scene = "PURCHASE"
+            rebates = rebate_rates.rebates(item.item_id, consumer.level, scene, verification.verification_quantity)
+            waiter = consumer.business_unit_employee
+            for customer_id, money, always in _split_rebates(rebates, waiter.customer_id, waiter.business_unit_id,
+                                                             org, role_ids):
+                if customer_id and (always or money > 0):
+                    ledger.append((verification.id, customer_id, money))
+
+        _apply_settlement(ledger)
+        return submit_return("返佣成功", "返佣失败",
+                             data={"settled": [v.id for v, _ in pending], "skipped": skipped})
+    except Exception as e:
+        db.session.rollback()
+        return false_return(message=str(e)), 400
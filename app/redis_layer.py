@@ -0,0 +1,124 @@
+from redis.client import Pipeline
+import redis
+import threading
+import time
+
+# 取出并删除，兼容不支持GETDEL(6.2+)的Redis
+GET_AND_DELETE_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('DEL', KEYS[1])
+end
+return value
+"""
+
+# 值相等时续期并返回1，否则返回0
+CHECK_AND_EXPIRE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# 值相等时删除并返回1，否则返回0
+CHECK_AND_DELETE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+return 0
+"""
+
+
+class RedisStats:
+    """
+    按命令统计调用次数和耗时，线程安全
+    """
+
+    def __init__(self):
+        # command -> [count, total seconds, max seconds]
+        self._stats = dict()
+        self._lock = threading.Lock()
+        self.listeners = list()
+
+    def record(self, command, elapsed):
+        with self._lock:
+            stat = self._stats.setdefault(command, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+        for listener in self.listeners:
+            listener(command, elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            return {command: {"count": count,
+                              "total_ms": round(total * 1000, 3),
+                              "avg_ms": round(total * 1000 / count, 3),
+                              "max_ms": round(maximum * 1000, 3)}
+                    for command, (count, total, maximum) in self._stats.items()}
+
+
+class InstrumentedPipeline(Pipeline):
+    stats = None
+
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            self.stats.record('PIPELINE', time.perf_counter() - start)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    记录每个命令耗时的Redis客户端，并提供减少往返次数的原子操作
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = RedisStats()
+        self._get_and_delete = self.register_script(GET_AND_DELETE_SCRIPT)
+        self._check_and_delete = self.register_script(CHECK_AND_DELETE_SCRIPT)
+        self._check_and_expire = self.register_script(CHECK_AND_EXPIRE_SCRIPT)
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            self.stats.record(args[0], time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.stats = self.stats
+        return pipe
+
+    def get_and_delete(self, key):
+        """
+        一次往返取出并删除key，不存在返回None，适用于一次性的邀请码等
+        """
+        return self._get_and_delete(keys=[key])
+
+    def check_and_delete(self, key, expected):
+        """
+        一次往返比较key的值，相等则删除，适用于一次性验证码
+        :return: bool
+        """
+        return bool(self._check_and_delete(keys=[key], args=[expected]))
+
+    def check_value(self, key, expected):
+        """
+        一次往返比较key的值，不删除
+        :return: bool
+        """
+        value = self.get(key)
+        return value is not None and value == expected
+
+    def check_and_expire(self, key, expected, expire):
+        """
+        一次往返比较key的值，相等则重新设置过期时间，适用于锁、租约续期
+        :param expire: 秒，可以是小数
+        :return: bool
+        """
+        return bool(self._check_and_expire(keys=[key], args=[expected, int(expire * 1000)]))
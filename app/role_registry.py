@@ -0,0 +1,154 @@
+from . import redis_db, logger
+from .models import get_model
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+import threading
+import time
+import os
+
+ROLE_CHANGED_CHANNEL = "role_registry::changed"
+
+
+class RoleRegistry:
+    """
+    进程内的角色名称与ID双向映射，角色表很少变化，查询直接读字典。
+    通过ORM事件监听角色表的增删改，事务提交后调用invalidate，通过Redis频道通知所有进程，下一次查询时重新加载。
+    订阅线程不访问数据库，只标记过期，因此不需要app context
+    """
+
+    def __init__(self, model, redis_client=redis_db, miss_reload_interval=1):
+        """
+        :param model: 角色model类
+        :param redis_client:
+        :param miss_reload_interval: 查不到名称时重新加载的最小间隔秒数，覆盖通知到达之前的新角色
+        """
+        self.model = model
+        self.table = model.__name__
+        self.redis = redis_client
+        self.miss_reload_interval = miss_reload_interval
+        # (name -> id, id -> name)
+        self._maps = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        for mutation in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(model, mutation, self._mark_changed)
+
+    def _mark_changed(self, mapper, connection, target):
+        # 只记录在session上，提交成功后再通知，回滚时丢弃
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('changed_role_registries', set()).add(self)
+
+    def warm(self):
+        """
+        一次查询加载全部角色，需要在app context中调用
+        """
+        model = self.model
+        ids = {name: role_id for role_id, name in model.query.with_entities(model.id, model.name).all()}
+        # 整体替换引用，读取时无需加锁
+        self._maps = (ids, {role_id: name for name, role_id in ids.items()})
+        self._loaded_at = time.time()
+        logger.info(f"{self.table} registry loaded, {len(ids)} roles")
+        return self._maps
+
+    def _lookup(self, index, key):
+        self._ensure_subscribed()
+        maps = self._maps
+        if maps is None:
+            with self._lock:
+                maps = self._maps or self.warm()
+        value = maps[index].get(key)
+        if value is None and time.time() - self._loaded_at > self.miss_reload_interval:
+            with self._lock:
+                value = self.warm()[index].get(key)
+        return value
+
+    def id(self, name):
+        """
+        :param name: 角色名称
+        :return: 角色ID，不存在时返回None
+        """
+        return self._lookup(0, name)
+
+    def name(self, role_id):
+        """
+        :param role_id: 角色ID
+        :return: 角色名称，不存在时返回None
+        """
+        return self._lookup(1, role_id)
+
+    def expire(self):
+        self._maps = None
+
+    def invalidate(self):
+        """
+        角色增删改提交后调用，使所有进程的映射过期
+        """
+        self.expire()
+        try:
+            self.redis.publish(ROLE_CHANGED_CHANNEL, self.table)
+        except Exception as e:
+            logger.error(f"publish {self.table} change failed, {e}")
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(ROLE_CHANGED_CHANNEL)
+                # 订阅断开期间可能错过通知
+                self.expire()
+                for message in pubsub.listen():
+                    if message.get('data') == self.table:
+                        self.expire()
+            except Exception as e:
+                logger.error(f"subscribe {ROLE_CHANGED_CHANNEL} failed, {e}")
+                time.sleep(5)
+
+    def _ensure_subscribed(self):
+        # gunicorn fork之后需要在当前进程重新订阅
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._listen, name=f"{self.table}-registry", daemon=True).start()
+            self._pid = os.getpid()
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_role_changes(session):
+    for registry in session.info.pop('changed_role_registries', set()):
+        registry.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_role_changes(session):
+    session.info.pop('changed_role_registries', None)
+
+
+def build_registry(table):
+    """
+    :param table: 模型名
+    :return: RoleRegistry，模型不存在时返回None
+    """
+    try:
+        model = get_model(table)
+    except Exception as e:
+        logger.info(f"{table} registry disabled, {e}")
+        return None
+    return RoleRegistry(model)
+
+
+customer_roles = build_registry("CustomerRoles")
+
+
+def customer_role_id(name):
+    """
+    CustomerRoles不存在时customer_roles为None，调用方统一通过此函数取ID
+    :param name: 客户角色名称
+    :return: 角色ID，角色不存在时返回None
+    """
+    if customer_roles is None:
+        raise Exception("model CustomerRoles does not exist")
+    return customer_roles.id(name)
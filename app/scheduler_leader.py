@@ -0,0 +1,144 @@
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+from . import redis_db, logger, scheduler
+from .models import make_uuid, REDIS_24H
+from .metrics import SCHEDULER_JOB_RUNS, SCHEDULER_JOB_LAST_DURATION, SCHEDULER_LEADER
+import threading
+import datetime
+import socket
+import atexit
+import json
+import time
+import os
+
+
+class SchedulerLeader:
+    """
+    多个gunicorn worker中只有持有Redis租约的一个运行定时任务。
+    所有worker都以暂停状态启动APScheduler，获得租约后resume，失去租约后pause；
+    leader按heartbeat间隔续期，退出或挂掉后其他worker最多在lease_ttl秒内接管。
+    任务的执行记录写入Redis，任一worker都可以查询
+    """
+
+    LEASE_KEY = "scheduler::leader"
+    JOBS_KEY = "scheduler::jobs"
+    HISTORY_KEY = "scheduler::history::{}"
+
+    def __init__(self, aps=scheduler, redis_client=redis_db):
+        self.scheduler = aps
+        self.redis = redis_client
+        self.identity = f"{socket.gethostname()}:{os.getpid()}:{make_uuid()}"
+        self.lease_ttl = 10
+        self.heartbeat = 3
+        self.history_size = 50
+        self.is_leader = False
+        self.election = False
+        self._renewed_at = 0
+        # job_id -> 本次开始时间
+        self._started = dict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.lease_ttl = app.config.get('SCHEDULER_LEASE_TTL', self.lease_ttl)
+        self.heartbeat = app.config.get('SCHEDULER_HEARTBEAT', self.heartbeat)
+        self.history_size = app.config.get('SCHEDULER_HISTORY_SIZE', self.history_size)
+        self.scheduler.add_listener(self._on_event,
+                                    EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+        self.election = bool(app.config.get('SCHEDULER_LEADER_ELECTION'))
+        if not self.election:
+            self.scheduler.resume()
+            return
+        threading.Thread(target=self._run, name="scheduler-leader", daemon=True).start()
+        atexit.register(self.release)
+
+    @property
+    def active(self):
+        """
+        当前worker是否应该运行单实例的后台任务(定时任务、job watcher)，未开启选举时每个worker都运行
+        """
+        return self.is_leader or not self.election
+
+    def _acquire_or_renew(self):
+        if self.is_leader:
+            return self.redis.check_and_expire(self.LEASE_KEY, self.identity, self.lease_ttl)
+        return bool(self.redis.set(self.LEASE_KEY, self.identity, nx=True, px=int(self.lease_ttl * 1000)))
+
+    def _run(self):
+        while True:
+            try:
+                holding = self._acquire_or_renew()
+                if holding:
+                    self._renewed_at = time.time()
+            except Exception as e:
+                logger.error(f"scheduler lease heartbeat failed, {e}")
+                # Redis不可用时，租约到期前仍视为leader，到期后其他worker可能已接管
+                holding = self.is_leader and time.time() - self._renewed_at < self.lease_ttl
+            if holding and not self.is_leader:
+                logger.info(f"{self.identity} became scheduler leader")
+                self.is_leader = True
+                self.scheduler.resume()
+            elif not holding and self.is_leader:
+                logger.info(f"{self.identity} lost scheduler leadership")
+                self.is_leader = False
+                self.scheduler.pause()
+            SCHEDULER_LEADER.set(1 if self.is_leader else 0)
+            time.sleep(self.heartbeat)
+
+    def release(self):
+        if self.is_leader:
+            self.is_leader = False
+            self.scheduler.pause()
+            try:
+                self.redis.check_and_delete(self.LEASE_KEY, self.identity)
+            except Exception as e:
+                logger.error(f"release scheduler lease failed, {e}")
+
+    def _on_event(self, event):
+        now = time.time()
+        if event.code == EVENT_JOB_SUBMITTED:
+            with self._lock:
+                self._started[event.job_id] = now
+            return
+        with self._lock:
+            started = self._started.pop(event.job_id, None)
+        if event.code == EVENT_JOB_MISSED:
+            status, duration = 'missed', None
+        else:
+            status = 'failed' if event.code == EVENT_JOB_ERROR else 'success'
+            duration = now - started if started else None
+        SCHEDULER_JOB_RUNS.labels(event.job_id, status).inc()
+        if duration is not None:
+            SCHEDULER_JOB_LAST_DURATION.labels(event.job_id).set(duration)
+        record = {"job_id": event.job_id,
+                  "status": status,
+                  "scheduled_run_time": str(event.scheduled_run_time),
+                  "finish_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                  "duration_ms": round(duration * 1000, 3) if duration is not None else None,
+                  "error": str(getattr(event, 'exception', None) or '') or None,
+                  "worker": self.identity}
+        try:
+            history_key = self.HISTORY_KEY.format(event.job_id)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.lpush(history_key, json.dumps(record))
+            pipe.ltrim(history_key, 0, self.history_size - 1)
+            pipe.expire(history_key, REDIS_24H)
+            pipe.hset(self.JOBS_KEY, event.job_id, json.dumps(record))
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"save scheduler job {event.job_id} history failed, {e}")
+
+    def status(self, history=10):
+        """
+        :param history: 每个任务返回的最近执行记录条数
+        :return: 当前leader及各任务最近一次执行结果与执行记录
+        """
+        jobs = {job_id: json.loads(record) for job_id, record in self.redis.hgetall(self.JOBS_KEY).items()}
+        for job_id, last in jobs.items():
+            last['history'] = [json.loads(r) for r in
+                               self.redis.lrange(self.HISTORY_KEY.format(job_id), 0, history - 1)]
+        return {"leader": self.redis.get(self.LEASE_KEY),
+                "worker": self.identity,
+                "is_leader": self.is_leader,
+                "jobs": jobs}
+
+
+scheduler_leader = SchedulerLeader()
@@ -0,0 +1,77 @@
+from . import redis_db, logger
+import threading
+import hashlib
+import json
+import time
+
+
+class SessionCache:
+    """
+    已验证登录会话的缓存，key为token的sha256，不保存token原文。
+    一级为进程内TTL字典，二级为Redis，缓存时间不超过JWT的exp。
+    其他进程登出后，本进程最多在local_ttl秒内仍使用本地缓存
+    """
+
+    def __init__(self, prefix, redis_client=redis_db, local_ttl=30):
+        self.prefix = prefix
+        self.redis_client = redis_client
+        self.local_ttl = local_ttl
+        # token hash -> (本地过期时间, session)
+        self._local = dict()
+        self._lock = threading.Lock()
+
+    def _key(self, token):
+        return f"{self.prefix}::{hashlib.sha256(token.encode()).hexdigest()}"
+
+    def get(self, token):
+        key = self._key(token)
+        now = time.time()
+        with self._lock:
+            cached = self._local.get(key)
+            if cached and cached[0] > now:
+                return cached[1]
+            self._local.pop(key, None)
+        try:
+            session = self.redis_client.get(key)
+        except Exception as e:
+            logger.error(f"get session from redis failed, {e}")
+            return None
+        if session is None:
+            return None
+        session = json.loads(session)
+        if session['exp'] <= now:
+            return None
+        with self._lock:
+            self._local[key] = (min(now + self.local_ttl, session['exp']), session)
+        return session
+
+    def set(self, token, exp, **session):
+        """
+        :param token: 认证token
+        :param exp: JWT的exp，unix时间戳
+        :param session: 需要缓存的会话信息，需可json序列化
+        """
+        now = time.time()
+        if exp <= now:
+            return
+        session['exp'] = exp
+        key = self._key(token)
+        with self._lock:
+            self._local[key] = (min(now + self.local_ttl, exp), session)
+        try:
+            self.redis_client.set(key, json.dumps(session), ex=int(exp - now) + 1)
+        except Exception as e:
+            logger.error(f"set session to redis failed, {e}")
+
+    def invalidate(self, token):
+        key = self._key(token)
+        with self._lock:
+            self._local.pop(key, None)
+        try:
+            self.redis_client.delete(key)
+        except Exception as e:
+            logger.error(f"delete session from redis failed, {e}")
+
+
+backstage_sessions = SessionCache('backstage_session')
+frontstage_sessions = SessionCache('frontstage_session')
@@ -17,8 +17,7 @@ def send_verification_code(phone, stage, template_id='576515', sms_sign='泛渤
     key = f"{stage}::verification_code::{phone}"
     try:
         result = ssender.send_with_param(86, phone, template_id, params, sign=sms_sign, extend="", ext="")
-        redis_db.set(key, code)
-        redis_db.expire(key, 305)
+        redis_db.set(key, code, ex=305)
     except HTTPError as e:
         return false_return(message=f"短信发送失败，HTTPError: {e}"), 400
     except Exception as e:
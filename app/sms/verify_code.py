@@ -29,7 +29,7 @@ class VerifyCode(Resource):
         """
         args = verify_code_parser.parse_args()
         key = args['stage'] + "::verification_code::" + kwargs['phone']
-        if redis_db.exists(key) and redis_db.get(key) == args['code']:
+        if redis_db.check_value(key, args['code']):
             return success_return(message="验证码正确")
         else:
             return false_return(message="手机不存在或者验证码错误"), 403
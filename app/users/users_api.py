@@ -1,12 +1,13 @@
 from flask import request
 from flask_restplus import Resource, reqparse
-from ..models import Users, Roles
+from ..models import Users, Roles, LoginInfo
 from . import users
 from app.auth import auths
 from .. import db, default_api
 from ..common import success_return, false_return, session_commit, submit_return
 from ..public_method import table_fields
 from ..public_user_func import create_user, modify_user_profile
+from ..session_cache import backstage_sessions
 from ..decorators import permission_required
 from ..swagger import return_dict, head_parser, page_parser
 from ..public_method import get_table_data, get_table_data_by_id
@@ -87,7 +88,7 @@ class QueryUsers(Resource):
         修改登陆用户自己的属性
         """
         args = update_user_parser.parse_args()
-        user = kwargs['info']['user']
+        user = Users.query.get(kwargs['info']['user_id'])
         fields_ = table_fields(Users, appends=['role_id', 'password'], removes=['password_hash'])
         return modify_user_profile(args, user, fields_)
 
@@ -118,7 +119,8 @@ class Logout(Resource):
         """
         用户登出
         """
-        login_info = info.get('login_info')
+        login_info = LoginInfo.query.get(info.get('login_info_id'))
+        backstage_sessions.invalidate(info.get('token'))
         db.session.delete(login_info)
         result = success_return(message="登出成功") if session_commit().get("code") == 'success' else false_return(
             message='登出失败'), 400
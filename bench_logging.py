@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+对比同步FileHandler与app.log_pipeline异步日志的每请求开销。
+模拟一次请求的日志量：login_required、new_data_obj、load_yaml等热点路径约8条DEBUG、1条INFO
+
+    python bench_logging.py --requests 20000 --threads 8
+"""
+import importlib.util
+import concurrent.futures
+import argparse
+import logging
+import tempfile
+import time
+import os
+
+# 直接按文件加载，避免导入app包时连接数据库、Redis
+_spec = importlib.util.spec_from_file_location(
+    'log_pipeline', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'log_pipeline.py'))
+log_pipeline = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(log_pipeline)
+
+PAYLOAD = {"job_name": "bench_job", "params": {"trading_day": "20201231", "tags": ["a", "b", "c"]}}
+
+
+def fake_request(logger, i):
+    logger.debug(f'IP 10.0.0.{i % 255} is checking login status')
+    for n in range(6):
+        logger.debug(f">>> The line exist in orders for {PAYLOAD} {n}")
+    logger.debug(f"yaml config of job {i} loaded")
+    logger.info(f"job bench-{i} submitted")
+
+
+def run(logger, requests, threads):
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda i: fake_request(logger, i), range(requests)))
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def sync_logger(path):
+    logger = logging.getLogger('bench.sync')
+    logger.propagate = False
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(fmt=log_pipeline.LOG_FORMAT, datefmt=log_pipeline.LOG_DATEFMT))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    return logger, handler.close
+
+
+def async_logger(name, path, **kwargs):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    handler = log_pipeline.setup_logging(logger, path, console=False, **kwargs)
+    return logger, handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        logger, close = sync_logger(os.path.join(tmp, 'sync.log'))
+        print(f"sync FileHandler           {run(logger, args.requests, args.threads):8.1f} us/request")
+        close()
+
+        cases = [('async', dict(level=logging.DEBUG)),
+                 ('async + sample 1/10', dict(level=logging.DEBUG, sample_rate=10)),
+                 ('async + module INFO', dict(level=logging.INFO))]
+        for n, (label, kwargs) in enumerate(cases):
+            logger, handler = async_logger(f'bench.async{n}', os.path.join(tmp, f'async{n}.log'), **kwargs)
+            per_request = run(logger, args.requests, args.threads)
+            start = time.perf_counter()
+            handler.listener.stop()
+            drain = time.perf_counter() - start
+            print(f"{label:<26} {per_request:8.1f} us/request, drain {drain * 1000:.0f} ms, "
+                  f"dropped {handler.dropped}")
+
+
+if __name__ == '__main__':
+    main()
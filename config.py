@@ -15,6 +15,38 @@ class Config:
     SQLALCHEMY_POOL_RECYCLE = 1800
     FLASKY_ADMIN = 'peter.chen@mbqianbao.com'
 
+    # 下游任务派发队列深度及worker线程数，DISPATCH_WORKERS为0时在请求中同步派发
+    DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE') or 100)
+    DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS') or 4)
+
+    # 每个k8s master一个watch，job结束后批量更新订单状态并自动派发下游任务
+    JOB_WATCHER_ENABLED = (os.environ.get('JOB_WATCHER_ENABLED') or '1') == '1'
+    JOB_WATCHER_FLUSH_INTERVAL = int(os.environ.get('JOB_WATCHER_FLUSH_INTERVAL') or 2)
+
+    # 异步日志：默认级别、按模块级别("public_method:INFO,pykube:WARNING")、DEBUG抽样比例、队列长度及轮转
+    LOG_FILE = os.environ.get('LOG_FILE') or 'run.log'
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
+    LOG_MODULE_LEVELS = os.environ.get('LOG_MODULE_LEVELS') or 'public_method:INFO,public_parser:INFO'
+    LOG_DEBUG_SAMPLE_RATE = int(os.environ.get('LOG_DEBUG_SAMPLE_RATE') or 1)
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE') or 10000)
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 100 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_DROP_REPORT_INTERVAL = int(os.environ.get('LOG_DROP_REPORT_INTERVAL') or 60)
+
+    # 请求级SQL/Redis/k8s统计，输出Server-Timing响应头，并记录超过PROFILER_SLOW_MS的最慢PROFILER_TOP_N条SQL
+    PROFILER_ENABLED = (os.environ.get('PROFILER_ENABLED') or '0') == '1'
+    PROFILER_SLOW_MS = int(os.environ.get('PROFILER_SLOW_MS') or 100)
+    PROFILER_TOP_N = int(os.environ.get('PROFILER_TOP_N') or 20)
+
+    # 使用metrics.TimedQueuePool记录数据库连接池的等待时间
+    METRICS_DB_POOL = (os.environ.get('METRICS_DB_POOL') or '1') == '1'
+
+    # 通过Redis租约选出一个worker运行定时任务，租约秒数即leader挂掉后其他worker接管的最长时间
+    SCHEDULER_LEADER_ELECTION = (os.environ.get('SCHEDULER_LEADER_ELECTION') or '1') == '1'
+    SCHEDULER_LEASE_TTL = int(os.environ.get('SCHEDULER_LEASE_TTL') or 10)
+    SCHEDULER_HEARTBEAT = int(os.environ.get('SCHEDULER_HEARTBEAT') or 3)
+    SCHEDULER_HISTORY_SIZE = int(os.environ.get('SCHEDULER_HISTORY_SIZE') or 50)
+
     @staticmethod
     def init_app(app):
         pass